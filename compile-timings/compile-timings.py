@@ -1,15 +1,30 @@
-import time
+import argparse
+import datetime
+import json
 import math
+import os
+import platform
+import sys
+import time
 import numpy as np
 import scipy
 
 from typing import Optional
 from math import cos, isinf, isnan, pi, sqrt
 
-# this needs pip install llvmlite to work
-from mathics.compile import CompileArg, CompileError, _compile, real_type
+# this needs pip install llvmlite to work; without it the llvm method is unavailable
+try:
+    from mathics.compile import CompileArg, CompileError, _compile, real_type
+    has_llvm = True
+except ImportError:
+    has_llvm = False
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 from mathics.core.expression import Expression
-from mathics.core.symbols import SymbolN, SymbolTrue
+from mathics.core.symbols import Symbol, SymbolN, SymbolTrue
 from mathics.core.atoms import Integer, Integer0, Real
 from mathics.builtin.scoping import dynamic_scoping
 from mathics.session import MathicsSession
@@ -130,6 +145,81 @@ def my_compile(expr, arg_names, lib = "np"):
     f = eval(python_def)
     return f
 
+#
+# numexpr: translate to a numexpr expression string, which numexpr evaluates
+# vectorized like python_np_vec, but in one fused multithreaded pass over the data
+# instead of one pass with a temporary array per operation
+#
+
+def to_numexpr_expr(expr):
+
+    funs = {
+        "System`Sin": "sin",
+        "System`Cos": "cos",
+        "System`Sqrt": "sqrt",
+    }
+
+    listops = {
+        "System`Plus": "+",
+        "System`Times": "*",
+    }
+
+    binops = {
+        "System`Power": "**",
+    }
+
+    if not hasattr(expr, "head"):
+        if str(expr).startswith("Global`"):
+            return str(expr).split("`")[1]
+        elif str(expr) == "System`I":
+            return "1j"
+        else:
+            return str(expr)
+    elif str(expr.head) in funs:
+        fun = funs[str(expr.head)]
+        args = (to_numexpr_expr(e) for e in expr.elements)
+        return f"{fun}({",".join(args)})"
+    elif str(expr.head) in listops:
+        args = (to_numexpr_expr(e) for e in expr.elements)
+        return f"({listops[str(expr.head)].join(args)})"
+    elif str(expr.head) in binops:
+        arg1 = to_numexpr_expr(expr.elements[0])
+        arg2 = to_numexpr_expr(expr.elements[1])
+        return f"({arg1}{binops[str(expr.head)]}{arg2})"
+    else:
+        raise Exception(f"numexpr can't do {expr.head}")
+
+def numexpr_compile(expr, arg_names):
+    numexpr_expr = to_numexpr_expr(expr)
+    python_arg_names = [n.split("`")[1] for n in arg_names]
+    def f(*args):
+        return numexpr.evaluate(numexpr_expr, local_dict=dict(zip(python_arg_names, args)))
+    return f
+
+#
+# the demo compiler, compile.demo_compile, with each of its backends
+#
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo"))
+
+# the demo compiler only knows Demo`Hypergeometric1F1, as System`Hypergeometric1F1
+# evaluates to other functions; see fe.py
+def demo_heads(expr):
+    if not hasattr(expr, "head"):
+        return expr
+    head = Symbol("Demo`Hypergeometric1F1") if str(expr.head) == "System`Hypergeometric1F1" else expr.head
+    return Expression(head, *(demo_heads(e) for e in expr.elements))
+
+def demo_compile(expr, arg_names, lib):
+    import compile as demo
+    fun = demo.demo_compile(session.evaluation, demo_heads(expr), [n.split("`")[1] for n in arg_names], lib=lib)
+    # we are timing the compiled code, not evaluation through Mathics
+    candidates = fun.candidates.values() if lib == "auto" else [fun]
+    assert not any(c.uses_pointwise for c in candidates), "evaluates some functions through Mathics"
+    def f(x, y, a, b):
+        return fun(x=x, y=y, a=a, b=b)
+    return f
+
 #
 #
 #
@@ -143,48 +233,164 @@ def choose_compile(expr, arg_names, method):
         return my_compile(expr, arg_names, "math")
     elif method == "python_np" or method == "python_np_vec":
         return my_compile(expr, arg_names, "np")
+    elif method == "numexpr":
+        return numexpr_compile(expr, arg_names)
+    elif method.startswith("demo_"):
+        return demo_compile(expr, arg_names, method[5:])
 
 #
+# Benchmark suite. For each expression, method, and grid size, we compile the
+# expression and then time evaluating it at every point of the grid, repeating
+# after some warmup runs, and report the median and 95th percentile times.
+# Results can be saved as JSON, and compared against a saved baseline, failing
+# if anything got slower than the baseline by more than a threshold.
 #
-#
 
-#expr_str, a, b, xlo, xhi, ylo, yhi = "Sin[(x^2+y^2)*a]*b", 1.5, 1.2, 0, 10, 0, 10
-#expr_str, a, b, xlo, xhi, ylo, yhi  = "Sin[(x^2+y^2)*a] / Sqrt[x^2+y^2+1] * b", 1.5, 1.2, 0, 10, 0, 10
-expr_str, a, b, xlo, xhi, ylo, yhi = "Hypergeometric1F1[a, b, (x + I y)^2]", 1, 2, -2, 2, -2, 2
-
-#method, n = "none", 1
-#method, n = "llvm", 1
-#method, n = "python_math", 1
-#method, n = "python_np", 10
-method, n = "python_np_vec", 10
-
-# compile expr_str
-session = MathicsSession()
-expr = session.parse(expr_str)
-fun = choose_compile(expr, ["Global`x", "Global`y", "Global`a", "Global`b"], method)
-
-# construct 40000 points on a 200x200 grid
-# xs, ys has xs and ys as two independent corresponding arrays each with shape (200,200)
-# xys has a flat list of 40000 (x,y) pairs
-xs = np.linspace(xlo, xhi, 200)
-ys = np.linspace(ylo, yhi, 200)
-xs, ys = np.meshgrid(xs, ys)
-xys = list(zip((float(x) for x in xs.ravel()), (float(y) for y in ys.ravel())))
-
-def timefun(f):
-    start = time.time()
-    for i in range(n):
-        f()
-    print(f"{(time.time()-start)/n*1000:.3f} ms")
-
-def f():
-    if method == "python_np_vec":
-        res = fun(xs, ys, a, b)
-        #print("res.shape", res.shape)
-        #print("isfinite", np.isfinite(res))
-        #print("min max", np.min(res), np.max(res))
+# name -> (expr, a, b, xlo, xhi, ylo, yhi)
+exprs = {
+    "expr1": ("Sin[(x^2+y^2)*a]*b", 1.5, 1.2, 0, 10, 0, 10),
+    "expr2": ("Sin[(x^2+y^2)*a] / Sqrt[x^2+y^2+1] * b", 1.5, 1.2, 0, 10, 0, 10),
+    "expr3": ("Hypergeometric1F1[a, b, (x + I y)^2]", 1, 2, -2, 2, -2, 2),
+    "expr4": ("Module[{z = 0, i}, For[i = 1, i <= 6, i++, z += b Sin[a^i x] Cos[a^i y] / i]; z]", 1.5, 1.2, 0, 10, 0, 10),
+}
+
+# methods that are called with one point at a time; the rest are called with whole arrays
+pointwise_methods = ["none", "llvm", "python_math", "python_np"]
+
+methods = [*pointwise_methods, "python_np_vec", "numexpr", "demo_np", "demo_numexpr", "demo_numba", "demo_auto"]
+
+def available(method):
+    if method == "llvm":
+        return has_llvm
+    elif method in ("numexpr", "demo_numexpr"):
+        return numexpr is not None
+    elif method == "demo_numba":
+        try:
+            import numba
+            return True
+        except ImportError:
+            return False
+    return True
+
+# the times in seconds of runs of fun on an n by n grid, or None if method can't compile expr
+def bench(expr_name, method, n, warmup, repeat):
+
+    expr_str, a, b, xlo, xhi, ylo, yhi = exprs[expr_name]
+    try:
+        fun = choose_compile(session.parse(expr_str), ["Global`x", "Global`y", "Global`a", "Global`b"], method)
+    except Exception as e:
+        print(f"{expr_name} {method}: can't compile: {e}")
+        return None
+
+    xs = np.linspace(xlo, xhi, n)
+    ys = np.linspace(ylo, yhi, n)
+    xs, ys = np.meshgrid(xs, ys)
+    if method in pointwise_methods:
+        xys = list(zip((float(x) for x in xs.ravel()), (float(y) for y in ys.ravel())))
+        def f():
+            for x, y in xys:
+                fun(x, y, a, b)
     else:
-        for x, y in xys:
-            fun(x, y, a, b)
+        def f():
+            fun(xs, ys, a, b)
+
+    times = []
+    try:
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            f()
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    except Exception as e:
+        print(f"{expr_name} {method}: can't evaluate: {e}")
+        return None
+    return times
+
+def environment():
+    import mathics
+    return dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        mathics=getattr(mathics, "__version__", "?"),
+        cpus=os.cpu_count(),
+    )
+
+def key(result):
+    return (result["expr"], result["method"], result["size"])
+
+# compare results against baseline, returning the regressions
+def compare(results, baseline, threshold):
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    print(f"\n{'expr':8} {'method':14} {'size':>5} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        ratio = r["median_ms"] / b["median_ms"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(r)
+            flag = "  REGRESSION"
+        print(f"{r['expr']:8} {r['method']:14} {r['size']:5} {b['median_ms']:10.3f} {r['median_ms']:10.3f} {ratio:7.2f}{flag}")
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compile micro-benchmarks")
+    parser.add_argument("--exprs", nargs="+", choices=list(exprs), default=list(exprs))
+    parser.add_argument("--methods", nargs="+", choices=methods, default=[m for m in methods if m != "none"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[50, 200, 400], help="grid is size by size")
+    parser.add_argument("--pointwise-max", type=int, default=50,
+                        help="largest size for methods that evaluate one point at a time, which are slow")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", type=str, default=None, help="write results to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against results saved with --json")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="fail if a median time is more than this times the baseline")
+    args = parser.parse_args()
+
+    global session
+    session = MathicsSession()
+
+    results = []
+    print(f"{'expr':8} {'method':14} {'size':>5} {'median ms':>10} {'p95 ms':>10}")
+    for expr_name in args.exprs:
+        for method in args.methods:
+            if not available(method):
+                print(f"{expr_name} {method}: not available")
+                continue
+            for n in args.sizes:
+                if method in pointwise_methods and n > args.pointwise_max:
+                    continue
+                # the pointwise methods are too slow to repeat much
+                repeat = 1 if method in pointwise_methods else args.repeat
+                warmup = 0 if method in pointwise_methods else args.warmup
+                times = bench(expr_name, method, n, warmup, repeat)
+                if times is None:
+                    break
+                times_ms = np.array(times) * 1000
+                result = dict(
+                    expr=expr_name, method=method, size=n, runs=len(times),
+                    median_ms=float(np.median(times_ms)), p95_ms=float(np.percentile(times_ms, 95)),
+                )
+                results.append(result)
+                print(f"{expr_name:8} {method:14} {n:5} {result['median_ms']:10.3f} {result['p95_ms']:10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(environment=environment(), results=results), f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold}x baseline")
+            sys.exit(1)
 
-timefun(f)
+if __name__ == "__main__":
+    main()
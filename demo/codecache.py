@@ -0,0 +1,92 @@
+"""
+On-disk cache for compile.demo_compile, so that a new process doesn't have to
+regenerate code for expressions that some earlier process already compiled.
+
+Entries are marshalled records containing code objects, one file per entry named by
+a hash of the key. The key includes the compiler version and the Python bytecode
+version, so stale entries are simply never looked up again, and get evicted.
+
+Several processes (e.g. dash workers) may share a cache directory. Entries are written
+to a temporary file and renamed into place, so a reader sees either a complete entry
+or none, and anything that can't be read is treated as a miss. The total size is
+bounded by evicting the least recently used entries, using file mtimes, which are
+updated on each hit.
+"""
+
+import hashlib
+import importlib.util
+import marshal
+import os
+import tempfile
+
+class DiskCache:
+
+    suffix = ".demo_compile"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        h = hashlib.sha256(repr((importlib.util.MAGIC_NUMBER, key)).encode()).hexdigest()
+        return os.path.join(self.directory, h + self.suffix)
+
+    # the record stored under key, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                record = marshal.load(f)
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # truncated or otherwise unreadable, e.g. by a different Python version
+            self.errors += 1
+            return None
+        self.hits += 1
+        return record
+
+    def put(self, key, record):
+        try:
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(record, f)
+            os.replace(temp, self.path(key))
+        except Exception as e:
+            print(f"can't write compile cache entry: {e}")
+            try:
+                os.remove(temp)
+            except Exception:
+                pass
+            return
+        self.evict()
+
+    # remove least recently used entries until we are within max_bytes
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # another process evicted it
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        return dict(directory=self.directory, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses, errors=self.errors)
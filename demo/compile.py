@@ -13,11 +13,24 @@ performance - essentially all the perform gain comes from using
 Python vectorized functions.
 """
 
+import ast
+import collections
+import contextlib
+import dataclasses
 import math
 import numpy as np
+import os
 import scipy
-
+import threading
+import time
+import tracemalloc
+import types
+
+import codecache
+import fused
+import jit
 import mcs
+import pool
 import util
 
 # TODO: to build this out, look for
@@ -55,6 +68,14 @@ def arctan(*args):
     else:
         raise Exception(f"arctan with {len(args)} args")
 
+def log(*args):
+    if len(args) == 1:
+        return np.log(args[0])
+    elif len(args) == 2:
+        return np.log(args[1]) / np.log(args[0])
+    else:
+        raise Exception(f"log with {len(args)} args")
+
 funs = {
 
     # TODO: this can generate discontinuous plots - need mechanism for segmented results?
@@ -63,8 +84,13 @@ funs = {
 
     mcs.SymbolSin: f"{lib}.sin",
     mcs.SymbolCos: f"{lib}.cos",
+    mcs.SymbolTan: f"{lib}.tan",
+    mcs.SymbolExp: f"{lib}.exp",
+    mcs.SymbolLog: "log",
     mcs.SymbolSqrt: f"{lib}.sqrt",
     mcs.SymbolAbs: f"{lib}.abs",
+    mcs.SymbolRe: f"{lib}.real",
+    mcs.SymbolIm: f"{lib}.imag",
     mcs.SymbolArcTan: "arctan",
 
     # just do Hypergemetric, no simplification
@@ -96,6 +122,17 @@ symbols = {
     mcs.SymbolPi: "math.pi"
 }
 
+# Heads we don't compile are evaluated through Mathics (see Pointwise), except those
+# whose values are True or False: Pointwise would return nan for them, which e.g.
+# np.where takes as true, so for those compilation fails and the caller falls back
+boolean_heads = set(mcs.Symbol("System`" + n) for n in [
+    "Less", "LessEqual", "Greater", "GreaterEqual", "Equal", "Unequal", "SameQ", "UnsameQ",
+    "And", "Or", "Not", "Xor", "Nand", "Nor", "Implies", "Equivalent", "TrueQ",
+])
+
+def pointwise_head(head):
+    return isinstance(head, mcs.Symbol) and head not in boolean_heads and not str(head).endswith("Q")
+
 def strip_context(s):
     return str(s).split("`")[-1]
 
@@ -207,6 +244,10 @@ class Ctx:
             elif str(expr) == "I":
                 # TODO: where does this come from??
                 result = "1j"
+            elif isinstance(expr, mcs.Symbol):
+                result = f"pointwise.constant({repr(str(expr))})"
+            elif isinstance(expr, mcs.Complex):
+                result = repr(complex(expr.to_python()))
             else:
                 result = str(expr)
 
@@ -293,6 +334,11 @@ class Ctx:
             arg2 = self.to_python_expr(expr.elements[1])
             result = f"({arg1}{binops[expr.head]}{arg2})"
 
+        elif pointwise_head(expr.head):
+            # evaluate through Mathics - see Pointwise
+            args = (self.to_python_expr(e) for e in expr.elements)
+            result = f"pointwise({",".join([repr(str(expr.head)), *args])})"
+
         else:
             raise Exception(f"Unknown head {expr.head} in {expr}")
 
@@ -307,31 +353,1635 @@ class Ctx:
                     yield from indent_stmts(d, indent = indent + 1)
         return "\n".join(indent_stmts(self.stmts))
 
-def demo_compile(evaluation, expr, arg_names, lib = "np"):
+
+#
+# AstCtx generates the same code as Ctx, with the same Scope semantics, but builds
+# Python ast nodes directly instead of strings, and the result is compiled to a code
+# object without going through the Python parser. Ctx remains the reference for
+# what the generated code should do; AstCtx should be kept in step with it.
+#
+# Building ast nodes avoids building and re-parsing large strings for things like
+# Module and For bodies, and symbol names only ever appear in the generated code
+# as identifiers or string constants, so there is no way for them to inject code.
+#
+
+# ast for an entry in one of the tables above (funs, symbols, etc.)
+# these are our own strings, so parsing them is safe
+def table_ast(s):
+    return ast.parse(s, mode="eval").body
+
+ast_binops = {
+    "**": ast.Pow,
+}
+
+ast_cmpops = {
+    ">": ast.Gt,
+    "<=": ast.LtE,
+}
+
+def load(name):
+    return ast.Name(name, ast.Load())
+
+def arguments(names):
+    return ast.arguments(
+        posonlyargs=[], args=[ast.arg(n) for n in names],
+        kwonlyargs=[], kw_defaults=[], defaults=[]
+    )
+
+def call(fun, *args):
+    return ast.Call(fun, list(args), [])
+
+class AstCtx:
+
+    def __init__(self, kind, has_scope=False, parent_scope=None, arg_names=[], scope_vars=[]):
+
+        self.name = Ctx.next_identifier(kind)
+        self.arg_names = arg_names
+        self.value = call(load(self.name), load("__"))
+
+        if has_scope:
+            parent_scope = load(parent_scope) if parent_scope else ast.Constant(None)
+            scope = ast.Call(
+                load("Scope"), [ast.Constant(self.name), parent_scope],
+                [ast.keyword(n, v) for n, v in scope_vars]
+            )
+            self.stmts = [ast.Assign([ast.Name("__", ast.Store())], scope)]
+        else:
+            self.stmts = []
+
+    def append_stmt(self, stmt_expr):
+        value = self.to_python_expr(stmt_expr)
+        self.stmts.append(ast.Expr(value))
+
+    def emit(self, parent):
+        arg_names = ["__", *(strip_context(n) for n in self.arg_names)]
+        args = ast.arguments(
+            posonlyargs=[], args=[ast.arg(n) for n in arg_names],
+            kwonlyargs=[], kw_defaults=[], defaults=[]
+        )
+        if len(self.stmts) and isinstance(self.stmts[-1], ast.Expr):
+            self.stmts[-1] = ast.Return(self.stmts[-1].value)
+        else:
+            print("xxx not returning", self.stmts)
+        parent.stmts.append(ast.FunctionDef(
+            self.name, args, self.stmts or [ast.Pass()],
+            decorator_list=[], returns=None, type_params=[]
+        ))
+
+    def to_python_expr(self, expr):
+
+        # helper for update operators like =, +=, *=, ++, et.
+        # update is a function that computes the new value from ast for the lhs and rhs
+        def update(expr, update, method):
+            target = strip_context(expr.elements[0])
+            rhs = self.to_python_expr(expr.elements[1]) if len(expr.elements) > 1 else None
+            lhs = self.to_python_expr(expr.elements[0])
+            value = update(lhs, rhs)
+            scope_method = ast.Attribute(load("__"), method, ast.Load())
+            return call(scope_method, ast.Constant(target), value)
+
+        if not hasattr(expr, "head"):
+            if str(expr).startswith("Global`"):
+                var = str(expr).split("`")[-1]
+                result = call(ast.Attribute(load("__"), "get", ast.Load()), ast.Constant(var))
+            elif expr in symbols:
+                result = table_ast(symbols[expr])
+            elif str(expr) == "I":
+                # TODO: where does this come from??
+                result = ast.Constant(1j)
+            elif isinstance(expr, mcs.String):
+                result = ast.Constant(expr.value)
+            elif expr.is_numeric():
+                result = ast.Constant(expr.to_python())
+            elif isinstance(expr, mcs.Symbol):
+                result = call(ast.Attribute(load("pointwise"), "constant", ast.Load()), ast.Constant(str(expr)))
+            else:
+                raise Exception(f"Unknown atom {expr}")
+
+        elif expr.head == mcs.SymbolModule:
+
+            body = expr.elements[1]
+
+            scope_vars = []
+            for e in expr.elements[0].elements:
+                if hasattr(e, "head") and e.head == mcs.SymbolSet:
+                    var = strip_context(str(e.elements[0]))
+                    val = self.to_python_expr(e.elements[1])
+                elif isinstance(e, mcs.Symbol):
+                    var = strip_context(str(e))
+                    val = ast.Constant(None)
+                else:
+                    raise Exception(f"Don't understand head element {str(e)} in {expr}")
+                scope_vars.append((var, val))
+
+            ctx = AstCtx("module", True, "__", [], scope_vars)
+            ctx.append_stmt(body)
+            ctx.emit(self)
+            return ctx.value
+
+        elif expr.head == mcs.SymbolCompoundExpression:
+
+            ctx = AstCtx("compound")
+            for e in expr.elements:
+                ctx.append_stmt(e)
+            ctx.emit(self)
+            return ctx.value
+
+        elif expr.head == mcs.SymbolFor:
+
+            ctx = AstCtx("for")
+
+            init = self.to_python_expr(expr.elements[0])
+            test = self.to_python_expr(expr.elements[1])
+            incr = self.to_python_expr(expr.elements[2])
+            body = self.to_python_expr(expr.elements[3])
+
+            ctx.stmts.extend([
+                ast.Expr(init),
+                ast.While(test, [
+                    ast.Assign([ast.Name(ctx.name, ast.Store())], body),
+                    ast.Expr(incr),
+                ], []),
+                ast.Expr(load(ctx.name))
+            ])
+
+            ctx.emit(self)
+
+            return ctx.value
+
+        elif expr.head == mcs.SymbolSet:
+            result = update(expr, lambda lhs, rhs: rhs, "set")
+        elif expr.head == mcs.SymbolIncrement:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Add(), ast.Constant(1)), "set_old")
+        elif expr.head == mcs.SymbolAddTo:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Add(), rhs), "set")
+        elif expr.head == mcs.SymbolTimesBy:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Mult(), rhs), "set")
+        elif expr.head == mcs.SymbolDivideBy:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Div(), rhs), "set")
+
+        elif expr.head in funs:
+            fun = table_ast(funs[expr.head])
+            args = (self.to_python_expr(e) for e in expr.elements)
+            result = call(fun, *args)
+
+        elif expr.head in listfuns:
+            fun = table_ast(listfuns[expr.head])
+            args = [self.to_python_expr(e) for e in expr.elements]
+            result = call(fun, ast.List(args, ast.Load()))
+
+        elif expr.head in binops:
+            arg1 = self.to_python_expr(expr.elements[0])
+            arg2 = self.to_python_expr(expr.elements[1])
+            op = binops[expr.head]
+            if op in ast_cmpops:
+                result = ast.Compare(arg1, [ast_cmpops[op]()], [arg2])
+            else:
+                result = ast.BinOp(arg1, ast_binops[op](), arg2)
+
+        elif pointwise_head(expr.head):
+            args = (self.to_python_expr(e) for e in expr.elements)
+            result = call(load("pointwise"), ast.Constant(str(expr.head)), *args)
+
+        else:
+            raise Exception(f"Unknown head {expr.head} in {expr}")
+
+        return result
+
+    # the generated code as a module ast and as Python source, for debugging
+    def stmts_to_module(self):
+        return ast.fix_missing_locations(ast.Module(self.stmts, type_ignores=[]))
+
+    def stmts_to_string(self):
+        return ast.unparse(self.stmts_to_module())
+
+#
+# FlatCtx generates code in which Mathics variables are resolved at compile time
+# to Python local variables, instead of being looked up by name in Scope objects at
+# run time. Module, CompoundExpression and For are inlined as flat statements in a
+# single function rather than generated as nested functions, and each Module local
+# gets its own Python name, so
+#
+#     Module[{z = 0, i}, For[i = 1, i <= n, i++, z += x]; z]
+#
+# compiles to something like
+#
+#     def __compiled1(__, x, n):
+#         z__1 = 0
+#         i__2 = None
+#         __for3 = None
+#         i__2 = 1
+#         while i__2 <= n:
+#             z__1 = z__1 + x
+#             __for3 = z__1
+#             __t4 = i__2
+#             i__2 = __t4 + 1
+#         return z__1
+#
+# Mathics names can't contain "_", so the renamed locals can't clash with each other
+# or with the arguments. A variable that isn't an argument or a Module local, which
+# Scope would reject at run time, raises ResolveError, and the caller falls back
+# to AstCtx and Scope.
+#
+
+class ResolveError(Exception):
+    pass
+
+class FlatCtx:
+
+    # if masked is True If is compiled to evaluate each branch only where it is selected
+    def __init__(self, arg_names, masked=False):
+        self.name = Ctx.next_identifier("compiled")
+        self.arg_names = arg_names
+        self.masked = masked
+        self.stmts = []
+        self.env = {strip_context(n): strip_context(n) for n in arg_names} # Mathics name -> Python name
+        self.counter = 0
+
+    def new_name(self, base):
+        self.counter += 1
+        return f"{base}{self.counter}" if base.startswith("__") else f"{base}__{self.counter}"
+
+    def assign(self, target, value):
+        self.stmts.append(ast.Assign([ast.Name(target, ast.Store())], value))
+        return load(target)
+
+    # the Python name for a variable, or ResolveError if it isn't in scope
+    def resolve(self, expr):
+        var = strip_context(expr)
+        if var not in self.env:
+            raise ResolveError(f"variable {var} is not an argument or Module local")
+        return self.env[var]
+
+    # compile each of exprs, in order, returning ast for their values
+    # if compiling an expr appends statements, the values of the exprs before it
+    # must be computed before those statements run, so are spilled to temporaries
+    def to_python_exprs(self, exprs):
+        values, ends = [], []
+        for e in exprs:
+            values.append(self.to_python_expr(e))
+            ends.append(len(self.stmts))
+        for i in reversed(range(len(values) - 1)):
+            if ends[i] < len(self.stmts) and not isinstance(values[i], ast.Constant):
+                temp = self.new_name("__t")
+                self.stmts.insert(ends[i], ast.Assign([ast.Name(temp, ast.Store())], values[i]))
+                values[i] = load(temp)
+        return values
+
+    # compile expr for its side effects only
+    def append_stmt(self, expr):
+        value = self.to_python_expr(expr)
+        if not isinstance(value, (ast.Name, ast.Constant)):
+            self.stmts.append(ast.Expr(value))
+
+    # compile a branch of If as an expression for use in a lambda,
+    # returning that and the names of the variables it uses
+    def branch(self, expr):
+        outer, self.stmts = self.stmts, []
+        value = self.to_python_expr(expr)
+        assert not self.stmts, "branch with statements"
+        self.stmts = outer
+        variables = set(self.env.values())
+        names = set(n.id for n in ast.walk(value) if isinstance(n, ast.Name) and n.id in variables)
+        return value, names
+
+    def emit(self, value):
+        arg_names = ["__", *(strip_context(n) for n in self.arg_names)]
+        fdef = ast.FunctionDef(
+            self.name, arguments(arg_names), [*self.stmts, ast.Return(value)],
+            decorator_list=[], returns=None, type_params=[]
+        )
+        return ast.fix_missing_locations(ast.Module([fdef], type_ignores=[]))
+
+    def to_python_expr(self, expr):
+
+        # helper for update operators like =, +=, *=, ++, et.
+        # update is a function that computes the new value from ast for the lhs and rhs
+        def update(expr, update):
+            target = self.resolve(expr.elements[0])
+            rhs = self.to_python_expr(expr.elements[1]) if len(expr.elements) > 1 else None
+            return self.assign(target, update(load(target), rhs))
+
+        if not hasattr(expr, "head"):
+            if str(expr).startswith("Global`"):
+                result = load(self.resolve(expr))
+            elif expr in symbols:
+                result = table_ast(symbols[expr])
+            elif str(expr) == "I":
+                result = ast.Constant(1j)
+            elif isinstance(expr, mcs.String):
+                result = ast.Constant(expr.value)
+            elif expr.is_numeric():
+                result = ast.Constant(expr.to_python())
+            elif isinstance(expr, mcs.Symbol):
+                result = call(ast.Attribute(load("pointwise"), "constant", ast.Load()), ast.Constant(str(expr)))
+            else:
+                raise Exception(f"Unknown atom {expr}")
+
+        elif expr.head == mcs.SymbolModule:
+
+            # initial values are computed in the enclosing scope
+            bindings = []
+            for e in expr.elements[0].elements:
+                if hasattr(e, "head") and e.head == mcs.SymbolSet:
+                    var = strip_context(str(e.elements[0]))
+                    val = self.to_python_expr(e.elements[1])
+                elif isinstance(e, mcs.Symbol):
+                    var = strip_context(str(e))
+                    val = ast.Constant(None)
+                else:
+                    raise Exception(f"Don't understand head element {str(e)} in {expr}")
+                bindings.append((var, self.new_name(var), val))
+
+            outer = self.env
+            self.env = dict(outer)
+            for var, name, val in bindings:
+                self.assign(name, val)
+                self.env[var] = name
+            result = self.to_python_expr(expr.elements[1])
+            self.env = outer
+
+        elif expr.head == mcs.SymbolCompoundExpression:
+            for e in expr.elements[:-1]:
+                self.append_stmt(e)
+            result = self.to_python_expr(expr.elements[-1])
+
+        elif expr.head == mcs.SymbolFor:
+
+            # like Ctx the value is that of the last execution of the body
+            result = load(self.new_name("__for"))
+            self.assign(result.id, ast.Constant(None))
+            self.append_stmt(expr.elements[0])
+
+            # compile test, body, and increment into their own statement lists
+            def block(e):
+                outer, self.stmts = self.stmts, []
+                v = self.to_python_expr(e)
+                stmts, self.stmts = self.stmts, outer
+                return stmts, v
+
+            test_stmts, test = block(expr.elements[1])
+            incr_stmts, incr = block(expr.elements[2])
+            if not isinstance(incr, (ast.Name, ast.Constant)):
+                incr_stmts.append(ast.Expr(incr))
+            body_stmts, body = block(expr.elements[3])
+            body_stmts.append(ast.Assign([ast.Name(result.id, ast.Store())], body))
+
+            if test_stmts:
+                exit = ast.If(ast.UnaryOp(ast.Not(), test), [ast.Break()], [])
+                loop = ast.While(ast.Constant(True), [*test_stmts, exit, *body_stmts, *incr_stmts], [])
+            else:
+                loop = ast.While(test, [*body_stmts, *incr_stmts], [])
+            self.stmts.append(loop)
+
+        elif expr.head == mcs.SymbolSet:
+            result = update(expr, lambda lhs, rhs: rhs)
+        elif expr.head == mcs.SymbolIncrement:
+            old = self.assign(self.new_name("__t"), load(self.resolve(expr.elements[0])))
+            update(expr, lambda lhs, rhs: ast.BinOp(old, ast.Add(), ast.Constant(1)))
+            result = old
+        elif expr.head == mcs.SymbolAddTo:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Add(), rhs))
+        elif expr.head == mcs.SymbolTimesBy:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Mult(), rhs))
+        elif expr.head == mcs.SymbolDivideBy:
+            result = update(expr, lambda lhs, rhs: ast.BinOp(lhs, ast.Div(), rhs))
+
+        elif expr.head == mcs.SymbolIf and self.masked and worth_masking(expr):
+            cond = self.to_python_exprs(expr.elements[:1])[0]
+            branches = [self.branch(e) for e in expr.elements[1:3]]
+            names = sorted(set().union(*(n for _, n in branches)))
+            lambdas = [ast.Lambda(arguments(names), b) for b, _ in branches]
+            result = call(load("masked_if"), cond, *lambdas, *(load(n) for n in names))
+
+        elif expr.head in funs:
+            fun = table_ast(funs[expr.head])
+            result = call(fun, *self.to_python_exprs(expr.elements))
+
+        elif expr.head in listfuns:
+            fun = table_ast(listfuns[expr.head])
+            args = self.to_python_exprs(expr.elements)
+            result = call(fun, ast.List(args, ast.Load()))
+
+        elif expr.head in binops:
+            arg1, arg2 = self.to_python_exprs(expr.elements[:2])
+            op = binops[expr.head]
+            if op in ast_cmpops:
+                result = ast.Compare(arg1, [ast_cmpops[op]()], [arg2])
+            else:
+                result = ast.BinOp(arg1, ast_binops[op](), arg2)
+
+        elif pointwise_head(expr.head):
+            args = self.to_python_exprs(expr.elements)
+            result = call(load("pointwise"), ast.Constant(str(expr.head)), *args)
+
+        else:
+            raise Exception(f"Unknown head {expr.head} in {expr}")
+
+        return result
+
+#
+# Common subexpression elimination. Expressions like Sin[x^2+y^2]/Sqrt[x^2+y^2+1]
+# would otherwise compute x^2+y^2 over the whole grid twice. This is done as a
+# rewrite of the Mathics expression before code generation, binding each repeated
+# subtree to a temporary in a Module, so it works the same for any code generator:
+#
+#     Module[{__cse1}, __cse1 = x^2+y^2; Sin[__cse1]/Sqrt[__cse1+1]]
+#
+# Temporaries are named __cse<n>, which can't clash with a Mathics variable
+# because Mathics symbol names can't contain "_".
+#
+
+# heads whose value depends only on the value of their arguments, so two
+# occurrences of the same subtree have the same value as long as none of
+# the variables in it are assigned anywhere
+pure_heads = set(funs) | set(listfuns) | set(binops)
+
+update_heads = set([
+    mcs.SymbolSet, mcs.SymbolIncrement, mcs.SymbolAddTo, mcs.SymbolTimesBy, mcs.SymbolDivideBy
+])
+
+# whether expr is more than an expression, so evaluating it has side effects
+def has_statements(expr):
+    return hasattr(expr, "elements") and (
+        expr.head in update_heads or expr.head in (mcs.SymbolModule, mcs.SymbolCompoundExpression, mcs.SymbolFor)
+        or any(has_statements(e) for e in expr.elements)
+    )
+
+# names of all symbols that are assigned to or are Module locals anywhere in expr
+def assigned_symbols(expr, result=None):
+    result = set() if result is None else result
+    if hasattr(expr, "elements"):
+        if expr.head in update_heads:
+            result.add(str(expr.elements[0]))
+        elif expr.head == mcs.SymbolModule:
+            for e in expr.elements[0].elements:
+                result.add(str(e.elements[0] if hasattr(e, "head") else e))
+        for e in expr.elements:
+            assigned_symbols(e, result)
+    return result
+
+def node_count(expr):
+    if not hasattr(expr, "elements"):
+        return 1
+    return 1 + sum(node_count(e) for e in expr.elements)
+
+# replace every subtree of expr whose structural key is key with replacement
+def replace_subtree(expr, key, replacement):
+    if not hasattr(expr, "elements"):
+        return expr
+    if structural_key(expr) == key:
+        return replacement
+    elements = [replace_subtree(e, key, replacement) for e in expr.elements]
+    if all(a is b for a, b in zip(elements, expr.elements)):
+        return expr
+    return mcs.Expression(expr.head, *elements)
+
+def is_pure(expr, assigned):
+    if not hasattr(expr, "elements"):
+        return not (isinstance(expr, mcs.Symbol) and str(expr) in assigned)
+    return expr.head in pure_heads and all(is_pure(e, assigned) for e in expr.elements)
+
+# Plus and Times are flat and orderless, so e.g. x^2+y^2 is not a subtree of x^2+y^2+1.
+# To let cse find it, this regroups x^2+y^2+1 as (x^2+y^2)+1 if x^2+y^2 also occurs
+# on its own, using the largest such group.
+def regroup(expr, assigned):
+
+    # first occurrence of each Plus or Times, keyed by head and the multiset of its elements
+    groups = {}
+    def collect(expr):
+        if hasattr(expr, "elements"):
+            for e in expr.elements:
+                collect(e)
+            if expr.head in (mcs.SymbolPlus, mcs.SymbolTimes) and is_pure(expr, assigned):
+                keys = tuple(sorted((structural_key(e) for e in expr.elements), key=repr))
+                groups.setdefault((expr.head, keys), expr)
+    collect(expr)
+
+    def rewrite(expr):
+        if not hasattr(expr, "elements"):
+            return expr
+        elements = [rewrite(e) for e in expr.elements]
+        if expr.head not in (mcs.SymbolPlus, mcs.SymbolTimes) or not is_pure(expr, assigned):
+            return mcs.Expression(expr.head, *elements)
+        keys = collections.Counter(structural_key(e) for e in elements)
+        best = None
+        for (head, group_keys), group in groups.items():
+            if head == expr.head and 1 < len(group_keys) < len(elements):
+                if collections.Counter(group_keys) <= keys and (not best or len(group_keys) > len(best[0])):
+                    best = (group_keys, group)
+        if best:
+            remaining = keys - collections.Counter(best[0])
+            rest = []
+            for e in elements:
+                key = structural_key(e)
+                if remaining[key]:
+                    remaining[key] -= 1
+                    rest.append(e)
+            elements = [best[1], *rest]
+        return mcs.Expression(expr.head, *elements)
+
+    return rewrite(expr)
+
+# returns the rewritten expression, and the number of nodes eliminated
+def cse(expr):
+
+    assigned = assigned_symbols(expr)
+    expr = regroup(expr, assigned)
+
+    # count occurrences of candidate subtrees, keyed by structural key
+    # returns the key for expr if it is a candidate, else None
+    def count(expr, counts, first):
+        if not hasattr(expr, "elements"):
+            ok = not (isinstance(expr, mcs.Symbol) and str(expr) in assigned)
+            return structural_key(expr) if ok else None
+        keys = [count(e, counts, first) for e in expr.elements]
+        if expr.head not in pure_heads or None in keys:
+            return None
+        key = (structural_key(expr.head), *keys)
+        counts[key] += 1
+        first.setdefault(key, expr)
+        return key
+
+    # repeatedly replace the largest repeated subtree with a temporary,
+    # including any occurrences in the definitions of previous temporaries
+    temps = []
+    eliminated = 0
+    while True:
+        counts = collections.Counter()
+        first = {}
+        for e in [expr, *(d for _, d in temps)]:
+            count(e, counts, first)
+        repeated = [key for key, n in counts.items() if n > 1]
+        if not repeated:
+            break
+        key = max(repeated, key=lambda key: node_count(first[key]))
+        sub = first[key]
+        eliminated += (counts[key] - 1) * node_count(sub)
+        temp = mcs.Symbol(f"Global`__cse{len(temps)+1}")
+        expr = replace_subtree(expr, key, temp)
+        temps = [(t, replace_subtree(d, key, temp)) for t, d in temps]
+        temps.append((temp, sub))
+
+    if not temps:
+        return expr, 0
+
+    # later temporaries are subtrees of earlier ones, so they are defined first
+    sets = [mcs.Expression(mcs.SymbolSet, t, d) for t, d in reversed(temps)]
+    body = mcs.Expression(mcs.SymbolCompoundExpression, *sets, expr)
+    expr = mcs.Expression(mcs.SymbolModule, mcs.ListExpression(*(t for t, _ in temps)), body)
+    return expr, eliminated
+
+#
+# Splitting out grid-only subexpressions. In a Manipulate like
+#
+#     Manipulate[Plot3D[Hypergeometric1F1[a, b, (x + I y)^2], ...], {a, ...}, {b, ...}]
+#
+# (x + I y)^2 depends only on the grid, not on the sliders a and b, so there is no
+# need to recompute it on every slider move. Given the names of the grid arguments,
+# split_invariants finds the maximal pure subtrees that depend only on those, and
+# replaces them with new arguments __inv<n>. The compiled function then computes
+# those separately (CompiledFunction.invariants), so that the caller can cache them
+# for a given grid, and pass them back in on subsequent calls.
+#
+
+# names of the Global` symbols in expr, i.e. the variables
+def global_symbols(expr):
+    if not hasattr(expr, "elements"):
+        return {str(expr)} if str(expr).startswith("Global`") else set()
+    return set().union(*(global_symbols(e) for e in expr.elements))
+
+# returns the rewritten expression, and a list of (symbol, subtree) for the hoisted subtrees
+def split_invariants(expr, grid_names):
+
+    assigned = assigned_symbols(expr)
+    grid = set("Global`" + n for n in grid_names)
+    invariants = {} # structural key -> (symbol, subtree)
+
+    def rewrite(expr):
+        if not hasattr(expr, "elements"):
+            return expr
+        symbols = global_symbols(expr)
+        if symbols and symbols <= grid and is_pure(expr, assigned):
+            key = structural_key(expr)
+            if key not in invariants:
+                invariants[key] = (mcs.Symbol(f"Global`__inv{len(invariants)+1}"), expr)
+            return invariants[key][0]
+        return mcs.Expression(expr.head, *(rewrite(e) for e in expr.elements))
+
+    expr = rewrite(expr)
+    return expr, list(invariants.values())
+
+#
+# Type inference. Whether each subexpression is real or complex, and scalar or array,
+# follows from the arguments: numpy only produces complex values from complex inputs,
+# so complex values come from I, complex constants, and functions of those. We use
+# that to find the real part of a complex-valued plot function without computing
+# complex arrays where we can, e.g. Re[Sin[x] + I y] is just Sin[x], and Abs[x + I y]
+# is Sqrt[x^2 + y^2]. Complex arithmetic is then only done where it is really needed,
+# like Hypergeometric1F1[a, b, (x + I y)^2], or on scalars, which is cheap.
+#
+
+Kind = collections.namedtuple("Kind", ["complex", "array"])
+
+def join(*kinds):
+    return Kind(any(k.complex for k in kinds), any(k.array for k in kinds))
+
+real_scalar = Kind(False, False)
+complex_scalar = Kind(True, False)
+unknown_kind = Kind(True, True)
+
+# heads whose result is real whatever their arguments are, and array if any argument is
+real_heads = set([mcs.SymbolAbs, mcs.SymbolRe, mcs.SymbolIm, mcs.SymbolGreater, mcs.SymbolLessEqual])
+
+# heads whose result is complex if any argument is, and array if any argument is
+join_heads = (pure_heads - real_heads - set([mcs.SymbolIf])) | set([mcs.SymbolCompoundExpression])
+
+# Plus and Times that simplify away the zeros that parts of real values produce
+zero = mcs.Integer(0)
+
+def is_number(expr, value):
+    return isinstance(expr, (mcs.Integer, mcs.Real)) and expr.to_python() == value
+
+def make_plus(*terms):
+    terms = [t for t in terms if not is_number(t, 0)]
+    return zero if not terms else terms[0] if len(terms) == 1 else mcs.Expression(mcs.SymbolPlus, *terms)
+
+def make_times(*factors):
+    if any(is_number(f, 0) for f in factors):
+        return zero
+    factors = [f for f in factors if not is_number(f, 1)] or [mcs.Integer(1)]
+    return factors[0] if len(factors) == 1 else mcs.Expression(mcs.SymbolTimes, *factors)
+
+class TypeInference:
+
+    # arg_kinds gives the Kind of each argument by name
+    def __init__(self, expr, arg_kinds):
+        self.env = {"Global`" + n: k for n, k in arg_kinds.items()}
+        self.kinds = {} # id(expr) -> Kind; valid for the duration of one pass
+
+        # the kind of a variable is the join of everything assigned to it anywhere;
+        # iterate because assignments in loops may depend on each other
+        assignments = list(self.assignments(expr))
+        changed = True
+        while changed:
+            changed = False
+            self.kinds = {}
+            for var, value in assignments:
+                kind = join(self.env.get(var, real_scalar), self.kind(value))
+                if kind != self.env.get(var):
+                    self.env[var] = kind
+                    changed = True
+        self.kinds = {}
+
+    # (variable name, value expression) for each assignment in expr
+    def assignments(self, expr):
+        if not hasattr(expr, "elements"):
+            return
+        if expr.head in update_heads and len(expr.elements) > 1:
+            yield str(expr.elements[0]), expr.elements[1]
+        elif expr.head == mcs.SymbolModule:
+            for e in expr.elements[0].elements:
+                if hasattr(e, "head") and e.head == mcs.SymbolSet:
+                    yield str(e.elements[0]), e.elements[1]
+        for e in expr.elements:
+            yield from self.assignments(e)
+
+    def kind(self, expr):
+        if id(expr) not in self.kinds:
+            self.kinds[id(expr)] = (expr, self._kind(expr)) # keep expr alive so id stays unique
+        return self.kinds[id(expr)][1]
+
+    def _kind(self, expr):
+        if not hasattr(expr, "elements"):
+            if str(expr).startswith("Global`"):
+                return self.env.get(str(expr), unknown_kind)
+            elif expr == mcs.SymbolI or isinstance(expr, mcs.Complex):
+                return complex_scalar
+            elif expr in symbols or isinstance(expr, mcs.String) or expr.is_numeric():
+                return real_scalar
+            return unknown_kind
+        kinds = [self.kind(e) for e in expr.elements]
+        if expr.head in real_heads:
+            return Kind(False, any(k.array for k in kinds))
+        elif expr.head == mcs.SymbolIf:
+            return join(*kinds[1:], Kind(False, kinds[0].array))
+        elif expr.head in join_heads:
+            return join(*kinds)
+        elif expr.head in update_heads:
+            return self.env.get(str(expr.elements[0]), unknown_kind)
+        elif expr.head == mcs.SymbolModule:
+            return kinds[1]
+        elif expr.head == mcs.SymbolFor:
+            return kinds[3]
+        return unknown_kind
+
+    # Real and imaginary parts of expr as expressions that don't compute complex
+    # arrays, or None if we don't know how to do that. In the latter case expr is
+    # complex array, and the caller should fall back to Re[expr] etc.
+    def parts(self, expr):
+        kind = self.kind(expr)
+        if not kind.complex:
+            return expr, zero
+        elif isinstance(expr, mcs.Complex):
+            return expr.real, expr.imag
+        elif expr == mcs.SymbolI:
+            return zero, mcs.Integer(1)
+        elif not kind.array:
+            return mcs.Expression(mcs.SymbolRe, expr), mcs.Expression(mcs.SymbolIm, expr)
+        elif not hasattr(expr, "elements"):
+            return None
+        elif expr.head == mcs.SymbolPlus:
+            parts = [self.parts(e) for e in expr.elements]
+            if all(parts):
+                return tuple(make_plus(*p) for p in zip(*parts))
+        elif expr.head == mcs.SymbolTimes:
+            # all the real factors, times one complex factor
+            real = [e for e in expr.elements if not self.kind(e).complex]
+            cplx = [e for e in expr.elements if self.kind(e).complex]
+            if len(cplx) > 1 and not any(self.kind(e).array for e in cplx):
+                cplx = [mcs.Expression(mcs.SymbolTimes, *cplx)]
+            if len(cplx) == 1 and (parts := self.parts(cplx[0])):
+                return tuple(make_times(*real, p) for p in parts)
+        return None
+
+    # an expression for the real part of expr
+    def real_part(self, expr):
+        if not self.kind(expr).complex:
+            return expr
+        elif getattr(expr, "head", None) == mcs.SymbolModule:
+            return mcs.Expression(mcs.SymbolModule, expr.elements[0], self.real_part(expr.elements[1]))
+        elif getattr(expr, "head", None) == mcs.SymbolCompoundExpression:
+            *init, last = expr.elements
+            return mcs.Expression(mcs.SymbolCompoundExpression, *init, self.real_part(last))
+        elif parts := self.parts(expr):
+            return parts[0]
+        return mcs.Expression(mcs.SymbolRe, expr)
+
+    # an expression for Abs[expr] that doesn't compute complex arrays, or None
+    def abs(self, expr):
+        if getattr(expr, "head", None) == mcs.SymbolPower and not self.kind(expr.elements[1]).complex:
+            # Abs[z^w] is Abs[z]^w for real w
+            if base := self.abs(expr.elements[0]):
+                return mcs.Expression(mcs.SymbolPower, base, expr.elements[1])
+        elif parts := self.parts(expr):
+            squares = (mcs.Expression(mcs.SymbolPower, p, mcs.Integer(2)) for p in parts if not is_number(p, 0))
+            return mcs.Expression(mcs.SymbolSqrt, make_plus(*squares))
+        return None
+
+    # rewrite Abs of complex values whose parts we can compute as real arrays
+    def abs_to_real(self, expr):
+        if not hasattr(expr, "elements"):
+            return expr
+        if expr.head == mcs.SymbolAbs and len(expr.elements) == 1 and self.kind(expr.elements[0]).complex:
+            if result := self.abs(expr.elements[0]):
+                return result
+        elements = [self.abs_to_real(e) for e in expr.elements]
+        if all(a is b for a, b in zip(elements, expr.elements)):
+            return expr
+        return mcs.Expression(expr.head, *elements)
+
+# Rewrite expr to avoid complex arrays where possible, and if real is True to compute
+# just the real part of expr. Returns the rewritten expression and its Kind.
+def realify(expr, arg_kinds, real):
+    types = TypeInference(expr, arg_kinds)
+    expr = types.abs_to_real(expr)
+    types = TypeInference(expr, arg_kinds)
+    if real:
+        expr = types.real_part(expr)
+        types = TypeInference(expr, arg_kinds)
+    return expr, types.kind(expr)
+
+#
+# Algebraic rewriting, after type inference and before cse and code generation.
+#
+# - Constant subexpressions are folded, including Pi and E, so e.g. 2 Pi x multiplies
+#   the grid once by 6.28..., instead of by 2 and then by Pi. Folding uses the same
+#   Python arithmetic that the generated code would have used at run time.
+# - Scalar factors of a Times, and scalar terms of a Plus, are grouped together ahead
+#   of the array ones, so e.g. a x b y with parameters a and b multiplies a by b once
+#   and then the grid by that, instead of multiplying the grid by a and then by b.
+# - Small integer powers become multiplications, e.g. x^3 is x x x, which is faster
+#   than numpy's general power. Higher powers square, e.g. x^4 is (x x) (x x), and
+#   cse then computes x x just once.
+#
+
+# largest integer power that we turn into multiplications
+max_power_chain = 8
+
+# heads that we fold when their arguments are constant; If would need a numpy array
+fold_heads = pure_heads - set([mcs.SymbolIf, mcs.SymbolList])
+
+# the Python value of a constant atom, or None
+def constant_value(expr):
+    if hasattr(expr, "elements"):
+        return None
+    elif expr == mcs.SymbolPi:
+        return math.pi
+    elif expr == mcs.SymbolE:
+        return math.e
+    elif expr == mcs.SymbolI:
+        return 1j
+    elif isinstance(expr, mcs.Complex):
+        return complex(expr.to_python())
+    elif expr.is_numeric():
+        value = expr.to_python()
+        return value if isinstance(value, (int, float)) else None
+    return None
+
+# the atom for a folded value, or None if it isn't a number we can represent
+def constant_atom(value):
+    if hasattr(value, "item"): # numpy scalar
+        value = value.item()
+    if isinstance(value, bool) or not isinstance(value, (int, float, complex)):
+        return None
+    return mcs.from_python(value)
+
+# x^n as a product, for an integer n > 0
+def power_chain(base, n):
+    if n == 1:
+        return base
+    half = power_chain(base, n // 2)
+    square = mcs.Expression(mcs.SymbolTimes, half, half)
+    return square if n % 2 == 0 else mcs.Expression(mcs.SymbolTimes, square, base)
+
+class Rewrite:
+
+    def __init__(self, expr, arg_kinds):
+        self.types = TypeInference(expr, arg_kinds)
+        self.assigned = assigned_symbols(expr)
+        self.temps = 0
+
+    def rewrite(self, expr):
+        if not hasattr(expr, "elements"):
+            return expr
+        elements = [self.rewrite(e) for e in expr.elements]
+        if not all(a is b for a, b in zip(elements, expr.elements)):
+            expr = mcs.Expression(expr.head, *elements)
+        if expr.head in fold_heads and (folded := self.fold(expr)) is not None:
+            return folded
+        if expr.head in (mcs.SymbolPlus, mcs.SymbolTimes) and not any(has_statements(e) for e in elements):
+            return self.reassociate(expr)
+        if expr.head == mcs.SymbolPower and len(elements) == 2:
+            return self.power(expr)
+        return expr
+
+    # the constant atom that expr evaluates to, or None if it isn't constant
+    def fold(self, expr):
+        values = [constant_value(e) for e in expr.elements]
+        if any(v is None for v in values):
+            return None
+        try:
+            if expr.head == mcs.SymbolPlus:
+                value = sum(values)
+            elif expr.head == mcs.SymbolTimes:
+                value = math.prod(values)
+            elif expr.head in binops and len(values) == 2:
+                a, b = values
+                value = a ** b if binops[expr.head] == "**" else None
+            else:
+                value = eval(funs[expr.head], globals())(*values)
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+        return constant_atom(value)
+
+    # fold the constant elements of Plus or Times into one, and put the scalar elements
+    # in their own Plus or Times ahead of the array ones
+    def reassociate(self, expr):
+        plus = expr.head == mcs.SymbolPlus
+        constants = [constant_value(e) for e in expr.elements]
+        others = [e for e, c in zip(expr.elements, constants) if c is None]
+        constants = [c for c in constants if c is not None]
+        constant = sum(constants) if plus else math.prod(constants)
+        scalars = [e for e in others if not self.types.kind(e).array]
+        arrays = [e for e in others if self.types.kind(e).array]
+
+        # adding 0 or multiplying by 1 does nothing, unless it is a float that
+        # would make an integer result float
+        if constants and not (constant == (0 if plus else 1) and isinstance(constant, int)):
+            atom = constant_atom(constant)
+            if atom is None:
+                return expr
+            scalars.insert(0, atom)
+
+        def make(elements):
+            return elements[0] if len(elements) == 1 else mcs.Expression(expr.head, *elements)
+        if not scalars and not arrays:
+            return constant_atom(constant)
+        return make(([make(scalars)] if scalars else []) + arrays)
+
+    # x^n as multiplications for small integers n
+    def power(self, expr):
+        base, exponent = expr.elements
+        n = exponent.to_python() if isinstance(exponent, mcs.Integer) else None
+        if n is None or not 2 <= abs(n) <= max_power_chain:
+            return expr
+        # the chain repeats the base, so unless that is an atom or a pure expression
+        # we evaluate it once into a temporary; it may have side effects, e.g. a For loop
+        if hasattr(base, "elements") and not is_pure(base, self.assigned):
+            self.temps += 1
+            temp = mcs.Symbol(f"Global`__pow{self.temps}")
+            self.types.env[str(temp)] = self.types.kind(base)
+            chain = power_chain(temp, abs(n))
+            chain = chain if n > 0 else mcs.Expression(mcs.SymbolPower, chain, mcs.Integer(-1))
+            local = mcs.Expression(mcs.SymbolSet, temp, base)
+            return mcs.Expression(mcs.SymbolModule, mcs.ListExpression(local), chain)
+        chain = power_chain(base, abs(n))
+        return chain if n > 0 else mcs.Expression(mcs.SymbolPower, chain, mcs.Integer(-1))
+
+def rewrite(expr, arg_kinds):
+    return Rewrite(expr, arg_kinds).rewrite(expr)
+
+#
+# Cache of compiled functions. Manipulate re-plots the same expression on every
+# slider move, and many panels may be doing that at once, so we keep a bounded
+# LRU cache keyed on the structure of the expression and the argument names
+# that lets us skip code generation entirely on a hit.
+#
+
+# A hashable key that captures the structure of expr: nested tuples of
+# head and element keys, with atoms represented by their type and string form,
+# so that e.g. Integer 1 and Real 1.0 are distinct keys.
+def structural_key(expr):
+    if not hasattr(expr, "elements"):
+        return (type(expr).__name__, str(expr))
+    return (structural_key(expr.head), *(structural_key(e) for e in expr.elements))
+
+class CompileCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock() # front ends may be handling several panels at once
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # look up key, returning None on a miss, and mark it most recently used on a hit
+    def get(self, key):
+        with self.lock:
+            fun = self.entries.get(key)
+            if fun is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return fun
+
+    # add an entry, evicting least recently used entries if we are full
+    def put(self, key, fun):
+        with self.lock:
+            self.entries[key] = fun
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(size=len(self.entries), maxsize=self.maxsize,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+cache = CompileCache(int(os.getenv("DEMO_COMPILE_CACHE_SIZE", "256")))
+
+# Optional persistent cache of generated code, shared by processes that use the
+# same directory. Bump COMPILER_VERSION whenever generated code changes.
+COMPILER_VERSION = 11
+disk_cache_dir = os.getenv("DEMO_COMPILE_CACHE_DIR")
+disk_cache_bytes = int(os.getenv("DEMO_COMPILE_CACHE_BYTES", str(64 * 1024 * 1024)))
+disk_cache = codecache.DiskCache(disk_cache_dir, disk_cache_bytes) if disk_cache_dir else None
+
+# which backend to use: "np", "numba" for a jit-compiled kernel where possible (see jit.py),
+# "numexpr" for fused evaluation of arithmetic expressions where possible (see fused.py),
+# or "auto" to choose among those by timing them - see AutoFunction
+default_lib = os.getenv("DEMO_COMPILE_LIB", "np")
+
+# which code generator to use: "ast" (FlatCtx, falling back to AstCtx),
+# "scope" (AstCtx), or "str" (Ctx)
+default_codegen = os.getenv("DEMO_COMPILE_CODEGEN", "ast")
+
+# whether ast code evaluates ufuncs into preallocated buffers - see pool.py
+default_inplace = os.getenv("DEMO_COMPILE_INPLACE", "1") != "0"
+
+#
+# Pointwise fallback. Heads that we don't know how to compile, like BesselJ or a
+# user-defined function, are evaluated through Mathics one point at a time, while
+# their arguments and the rest of the expression are still compiled and vectorized.
+# The generated code calls pointwise(head, *args), which evaluates N[head[args]] for
+# each distinct combination of argument values and scatters the results back, so
+# e.g. BesselJ[0, x] on an n by n grid only evaluates n times. Nothing is remembered
+# across calls, as the values depend on the current definitions, e.g. of a
+# user-defined function, which may change between calls.
+#
+
+class Pointwise:
+
+    # Mathics evaluation is not thread-safe, and tiles of a grid may be evaluated on
+    # several threads, so we serialize all evaluation through Mathics
+    lock = threading.Lock()
+
+    def __init__(self, evaluation):
+        self.evaluation = evaluation
+        self.failed = set() # heads that raised exceptions, so we only say so once
+
+    # evaluate head[args], or just head if args is None
+    def evaluate(self, head, args):
+        expr = mcs.Symbol(head)
+        if args is not None:
+            expr = mcs.Expression(expr, *(mcs.from_python(a) for a in args))
+        try:
+            with self.lock:
+                result = mcs.Expression(mcs.SymbolN, expr).evaluate(self.evaluation)
+            value = result.to_python() if result.is_numeric() else math.nan
+        except Exception as e: # e.g. from sympy, which Mathics uses for some functions
+            if head not in self.failed:
+                print(f"can't evaluate {expr}, using nan: {e}")
+                self.failed.add(head)
+            value = math.nan
+        if not isinstance(value, (int, float, complex)):
+            value = math.nan
+        return value
+
+    # value of a symbol like Degree
+    def constant(self, name):
+        return self.evaluate(name, None)
+
+    def __call__(self, head, *args):
+
+        # all scalars: just one evaluation
+        if not any(isinstance(a, np.ndarray) and a.shape != () for a in args):
+            return self.evaluate(head, tuple(a.item() if hasattr(a, "item") else a for a in args))
+
+        # evaluate on the unique rows of the table of argument values
+        arrays = np.broadcast_arrays(*(np.asarray(a) for a in args))
+        table = np.stack([a.ravel() for a in arrays], axis=-1)
+        unique, inverse = np.unique(table, axis=0, return_inverse=True)
+        values = [self.evaluate(head, tuple(row.tolist())) for row in unique]
+        dtype = complex if any(isinstance(v, complex) for v in values) else float
+        return np.array(values, dtype)[inverse.ravel()].reshape(arrays[0].shape)
+
+#
+# Masked evaluation of If. np.where(cond, a, b) computes both a and b over the whole
+# grid, which is wasteful if they are expensive, e.g. special functions. Instead
+# FlatCtx compiles If[cond, a, b] in masked mode to
+#
+#     masked_if(cond, lambda x, y: a, lambda x, y: b, x, y)
+#
+# which evaluates each branch on just the elements of x and y that select it,
+# and scatters the results. If cond is a scalar only the selected branch is evaluated.
+# Nested Ifs in a branch are masked in turn, on the already-masked variables.
+#
+
+# heads that are cheap enough that masking isn't worth it
+cheap_heads = set(listfuns) | set(binops)
+
+# whether it's worth evaluating If[cond, a, b] masked: the branches have to be
+# expressions, without assignments, and at least one must contain something expensive
+def worth_masking(expr):
+    if len(expr.elements) != 3:
+        return False
+    def expensive(e):
+        return hasattr(e, "elements") and (e.head not in cheap_heads or any(expensive(a) for a in e.elements))
+    branches = expr.elements[1:]
+    return any(expensive(b) for b in branches) and not any(has_statements(b) for b in branches)
+
+# A branch may just return one of the variables, or a view of one, and the result
+# of masked_if may be updated in place (see pool.consumers), so where we return what
+# a branch returns it is copied.
+def masked_if(cond, if_true, if_false, *variables):
+
+    # scalar cond: evaluate just one branch
+    if not isinstance(cond, np.ndarray) or cond.shape == ():
+        value = if_true(*variables) if cond else if_false(*variables)
+        return value.copy() if isinstance(value, np.ndarray) else value
+
+    shape = np.broadcast_shapes(cond.shape, *(v.shape for v in variables if isinstance(v, np.ndarray)))
+    mask = np.broadcast_to(cond, shape)
+    if mask.all():
+        return np.array(np.broadcast_to(if_true(*variables), shape))
+    elif not mask.any():
+        return np.array(np.broadcast_to(if_false(*variables), shape))
+
+    def select(m):
+        return [np.broadcast_to(v, shape)[m] if isinstance(v, np.ndarray) and v.shape != () else v for v in variables]
+    a = if_true(*select(mask))
+    not_mask = ~mask
+    b = if_false(*select(not_mask))
+    result = np.empty(shape, np.result_type(a, b))
+    result[mask] = a
+    result[not_mask] = b
+    return result
+
+# masked_if doesn't hold on to its arguments, so they can be in pool buffers
+pool.consumers.add(masked_if)
+
+# whether FlatCtx compiles If masked
+default_masked = os.getenv("DEMO_COMPILE_MASKED", "1") != "0"
+
+#
+# Compile reports. Every compiled function has a CompileReport, fun.report, that
+# says how it was compiled and what came out, and accumulates timings of calls to it,
+# for finding out why a plot is slow. DEMO_COMPILE_REPORT=1 prints the report whenever
+# demo_compile returns a function; DEMO_COMPILE_REPORT=2 also prints it after every
+# call, and records the peak memory allocated during each call, which is slower.
+#
+
+report_level = int(os.getenv("DEMO_COMPILE_REPORT", "0"))
+
+@dataclasses.dataclass
+class CompileReport:
+    node_count: int             # nodes in the expression as given
+    codegen_seconds: float      # time taken to compile it, when it was compiled
+    cache: str                  # latest lookup: "compiled", "disk", or "memory"
+    backend: str                # np, numexpr, or numba
+    codegen: str                # ast, scope, or str
+    temporaries: int            # intermediate arrays the buffer pool planned; 0 without inplace
+    code: str                   # the generated code
+    calls: int = 0
+    call_seconds: float = 0.0   # total over all calls
+    last_call_seconds: float = 0.0
+    peak_bytes: int = 0         # largest allocated during a call; only with DEMO_COMPILE_REPORT=2
+
+    def __str__(self):
+        lines = [
+            f"compiled {self.node_count} nodes in {self.codegen_seconds*1000:.1f} ms ({self.cache}),"
+            f" backend {self.backend}, codegen {self.codegen}, {self.temporaries} temporaries",
+            *("    " + line for line in self.code.splitlines()),
+        ]
+        if self.calls:
+            lines.append(self.calls_summary())
+        return "\n".join(lines)
+
+    def calls_summary(self):
+        mean = self.call_seconds / self.calls
+        memory = f", peak {self.peak_bytes/1e6:.1f} MB" if self.peak_bytes else ""
+        return f"{self.calls} calls, last {self.last_call_seconds*1000:.2f} ms, mean {mean*1000:.2f} ms{memory}"
+
+    # record a call; tiles evaluated on several threads at once all add to the peak
+    @contextlib.contextmanager
+    def call(self):
+        track = report_level >= 2
+        if track:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.last_call_seconds = time.perf_counter() - start
+            self.call_seconds += self.last_call_seconds
+            self.calls += 1
+            if track:
+                self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1] - before)
+                print(self.calls_summary())
+
+#
+# Main entry point.
+#
+# Compiles expr into a CompiledFunction that takes values for arg_names as keyword arguments.
+# If grid_names is supplied it names the subset of arg_names that are the grid (e.g. x and y),
+# and the remaining arguments are parameters (e.g. Manipulate sliders) - see split_invariants.
+#
+
+def demo_compile(
+    evaluation, expr, arg_names, lib = None, codegen = None, grid_names = None,
+    inplace = None, real = False, masked = None
+):
+    lib = lib or default_lib
+    if lib == "auto":
+        options = dict(codegen=codegen, grid_names=grid_names, inplace=inplace, real=real, masked=masked)
+        return demo_compile_auto(evaluation, expr, arg_names, options)
+    codegen = codegen or default_codegen
+    grid_names = tuple(grid_names) if grid_names else ()
+    inplace = default_inplace if inplace is None else inplace
+    masked = default_masked if masked is None else masked
+    options = dict(inplace=inplace, masked=masked)
+    key = (structural_key(expr), tuple(arg_names), lib, codegen, grid_names, real, tuple(options.items()))
+    fun = cache.get(key)
+    if fun is not None:
+        fun.report.cache = "memory"
+    else:
+        disk_key = (COMPILER_VERSION, key)
+        record = disk_cache.get(disk_key) if disk_cache else None
+        status = "disk"
+        if record is None:
+            start = time.perf_counter()
+            record = _demo_compile(evaluation, expr, arg_names, lib, codegen, grid_names, real, options)
+            record["report"]["codegen_seconds"] = time.perf_counter() - start
+            record["report"]["node_count"] = node_count(expr)
+            if disk_cache:
+                disk_cache.put(disk_key, record)
+            status = "compiled"
+        fun = CompiledFunction(evaluation, record)
+        fun.report = CompileReport(**record["report"], cache=status, backend=fun.lib, codegen=codegen)
+        # a function that evaluates things through Mathics is bound to this evaluation,
+        # so is not shared; the generated code can still come from the disk cache
+        if not fun.uses_pointwise:
+            cache.put(key, fun)
+    if report_level:
+        print(fun.report)
+    return fun
+
+# If real is True the compiled function computes the real part of expr, e.g. for plotting.
+# options are passed on to codegen_fun.
+# Returns a record of the generated code that CompiledFunction turns into a function;
+# this is what is saved in the disk cache, so must be marshallable.
+def _demo_compile(evaluation, expr, arg_names, lib, codegen, grid_names, real, options):
 
     #Ctx.lib = lib # TODO: not actually hooked up
 
-    ctx = Ctx("compiled", True, None, arg_names, zip(arg_names, arg_names))
-    ctx.append_stmt(expr)
+    # the generated code can only use arguments and Module locals; anything else, e.g. a
+    # variable with a global value, would fail at run time, so callers that can fall back
+    # to Mathics should do so now
+    free = global_symbols(expr) - assigned_symbols(expr) - set("Global`" + n for n in arg_names)
+    if free:
+        raise ResolveError(f"not arguments or Module locals: {', '.join(sorted(strip_context(n) for n in free))}")
+
+    # arguments are real; with a grid the other arguments are scalar parameters
+    with util.Timer("types"):
+        arg_kinds = {n: Kind(False, not grid_names or n in grid_names) for n in arg_names}
+        expr, kind = realify(expr, arg_kinds, real)
+
+    with util.Timer("rewrite"):
+        expr = rewrite(expr, arg_kinds)
+
+    # only worth splitting if there are parameters that are not grid arguments
+    invariants = []
+    if grid_names and set(arg_names) - set(grid_names):
+        with util.Timer("split invariants"):
+            expr, invariants = split_invariants(expr, grid_names)
+    invariant_names = [strip_context(symbol) for symbol, _ in invariants]
+
+    fun, kernel = compile_expr(expr, [*arg_names, *invariant_names], codegen, options, lib)
+    if invariants:
+        grid_expr = mcs.ListExpression(*(subtree for _, subtree in invariants))
+        grid_fun, _ = compile_expr(grid_expr, grid_names, codegen, options)
+    else:
+        grid_fun = None
+
+    # for CompileReport; demo_compile fills in the rest
+    code = fun[3]
+    if grid_fun:
+        code = f"# grid invariants:\n{grid_fun[3]}\n{code}"
+    if isinstance(kernel, tuple):
+        code += f"\n# numba point function:\n{kernel[3]}"
+    elif kernel:
+        code += f"\n# numexpr:\n{kernel}"
+    report = dict(code=code, temporaries=fun[4])
+
+    return dict(
+        fun=fun, lib=lib, kernel=kernel, grid_fun=grid_fun, grid_names=tuple(grid_names),
+        invariant_names=tuple(invariant_names), kind=tuple(kind), report=report
+    )
+
+# returns the generated numpy code, and for lib="numba" the generated point function
+# for a kernel, or for lib="numexpr" the expression string, or None if there isn't one
+def compile_expr(expr, arg_names, codegen, options, lib="np"):
+
+    # numexpr can only evaluate expressions, not the Module that cse introduces;
+    # recomputing common subexpressions in a fused evaluation costs little anyway
+    kernel = None
+    if lib == "numexpr":
+        with util.Timer("codegen numexpr"):
+            kernel = codegen_numexpr(expr, arg_names)
+
+    with util.Timer("cse"):
+        expr, eliminated = cse(expr)
+
+    with util.Timer(f"codegen (cse eliminated {eliminated} nodes)"):
+        generated = codegen_fun(expr, arg_names, codegen, **options)
+
+    if lib == "numba":
+        with util.Timer("codegen kernel"):
+            kernel = codegen_kernel(expr, arg_names)
+
+    return generated, kernel
+
+class CompiledFunction:
+
+    # record is as returned by _demo_compile
+    def __init__(self, evaluation, record):
+        self.kind = Kind(*record["kind"]) # whether the result may be complex and whether it is an array
+        self.fun = load_fun(evaluation, record["fun"])
+        self.lib = "np" # the backend actually used
+        kernel = record["kernel"]
+        if kernel and record["lib"] == "numba" and jit.available():
+            self.fun = jit.Kernel(exec_code(evaluation, kernel), self.fun)
+            self.lib = "numba"
+        elif kernel and record["lib"] == "numexpr" and fused.available():
+            self.fun = fused.Function(kernel, self.fun)
+            self.lib = "numexpr"
+        self.parallel = getattr(self.fun, "parallel", False) # whether fun is already multithreaded
+        self.grid_fun = load_fun(evaluation, record["grid_fun"]) if record["grid_fun"] else None
+        # whether anything is evaluated through Mathics - see Pointwise
+        self.uses_pointwise = any(uses_pointwise(g) for g in (record["fun"], record["grid_fun"]) if g)
+        self.grid_names = record["grid_names"]
+        self.invariant_names = record["invariant_names"]
+
+    # compute the grid-only subexpressions from the grid arguments, returning a dict
+    # that the caller may cache for a given grid and pass back in to __call__
+    def invariants(self, **kwargs):
+        if self.grid_fun is None:
+            return {}
+        values = self.grid_fun(**{n: kwargs[n] for n in self.grid_names})
+        return dict(zip(self.invariant_names, values))
+
+    # if out is supplied the result is written there, and out is returned
+    # invariants and out are positional-only so they can't clash with argument names
+    def __call__(self, invariants=None, out=None, /, **kwargs):
+        if invariants is None:
+            invariants = self.invariants(**kwargs)
+        with self.report.call():
+            return self.fun(out, **kwargs, **invariants)
+
+    # evaluate for each of several values of the parameters named by names - see sweep
+    def sweep(self, names, invariants=None, /, **kwargs):
+        return sweep(self, names, invariants, kwargs)
+
+#
+# Parameter sweeps. To precompute e.g. every frame of a Manipulate slider, instead of
+# calling the compiled function once per value of the slider parameter a,
+#
+#     fun.sweep(["a"], x=xs, y=ys, a=np.linspace(0, 1, 50), b=2)
+#
+# passes a in as an array of shape (50, 1, 1), so that one broadcast evaluation
+# computes all 50 frames as an array of shape (50, ny, nx). Several parameters can be
+# swept together, taking the i'th value of each for frame i. Anything that can't be
+# evaluated that way, like a For loop whose count depends on a swept parameter,
+# is evaluated one frame at a time instead.
+#
 
-    # TODO: hokey - rework
-    dummy = Ctx("dummy")
-    ctx.emit(dummy)
-    code = dummy.stmts_to_string()
+# fun is a CompiledFunction or AutoFunction, and kwargs are its arguments,
+# with the values for each of names a 1-d array, all of the same length
+def sweep(fun, names, invariants, kwargs):
+
+    values = {n: np.asarray(kwargs[n]) for n in names}
+    lengths = set(v.shape for v in values.values())
+    if len(lengths) != 1 or len(next(iter(lengths))) != 1:
+        raise ValueError(f"swept parameters must be 1-d arrays of the same length, not {lengths}")
+    n = next(iter(lengths))[0]
+
+    if invariants is None:
+        invariants = fun.invariants(**kwargs)
+    fixed = [v for name, v in (*kwargs.items(), *invariants.items()) if name not in values]
+    grid_shape = np.broadcast_shapes(*(np.shape(v) for v in fixed))
+    shape = (n, *grid_shape)
+
+    # a List evaluates to a list of its elements, as from CompiledFunction,
+    # so we sweep each of those
+    def components(result):
+        return result if isinstance(result, list) else [result]
+    def like(result, swept):
+        return swept if isinstance(result, list) else swept[0]
+
+    # numpy raises ValueError for arrays that don't broadcast, or that are used where a
+    # single value is needed, e.g. a For loop count, so we go one value at a time
+    try:
+        swept = {name: v.reshape(n, *(1 for _ in grid_shape)) for name, v in values.items()}
+        with util.Timer("sweep"):
+            result = fun(invariants, None, **{**kwargs, **swept})
+            arrays = [np.asarray(c) for c in components(result)]
+            return like(result, [c if c.shape == shape else np.broadcast_to(c, shape).copy() for c in arrays])
+    except ValueError:
+        pass
+
+    with util.Timer("sweep one at a time"):
+        results = [
+            fun(invariants, None, **{**kwargs, **{name: v[i].item() for name, v in values.items()}})
+            for i in range(n)
+        ]
+        frames = zip(*(components(result) for result in results))
+        return like(results[0], [np.stack([np.broadcast_to(c, grid_shape) for c in frame]) for frame in frames])
 
-    #print("xxx compiling:"); util.prt(expr)
-    #print("xxx compiled:"); print(code)
+#
+# Autotuning. Which backend is fastest depends on the expression and on the size of
+# the grid: numexpr and numba have some overhead per call that only pays off for
+# large enough grids, numba can't do everything, and so on. With lib="auto" we
+# compile the expression with each of the available backends, and the first time
+# the function is called with a given size of grid, time each of them on a sample
+# of the grid and use the fastest from then on. The winners are remembered in
+# autotune_results, keyed by the structure of the expression and the grid size,
+# along with the timings, for inspection.
+#
 
-    # compute the top-level function
-    ns = locals()
-    exec(code, globals(), ns)
+# candidate backends, in order of preference if they are equally fast
+autotune_libs = ["np", "numexpr", "numba"]
+
+# target number of points in the sample of the grid that we time on
+autotune_points = int(os.getenv("DEMO_AUTOTUNE_POINTS", "16384"))
+
+# number of timed calls per backend; we take the fastest
+autotune_repeats = 3
+
+# (key, grid size, whether timed tiled) -> (winning lib, {lib: seconds per call})
+autotune_results = {}
+autotune_lock = threading.Lock()
+
+# options are the other arguments to demo_compile
+def demo_compile_auto(evaluation, expr, arg_names, options):
+    candidates = {}
+    for lib in autotune_libs:
+        if lib == "numexpr" and not fused.available() or lib == "numba" and not jit.available():
+            continue
+        fun = demo_compile(evaluation, expr, arg_names, lib=lib, **options)
+        # e.g. lib="numexpr" for an expression numexpr can't do is just np again
+        if fun.lib not in candidates:
+            candidates[fun.lib] = fun
+    options = {n: tuple(v) if isinstance(v, list) else v for n, v in options.items()}
+    key = (structural_key(expr), tuple(arg_names), tuple(options.items()))
+    return AutoFunction(key, candidates)
+
+class AutoFunction:
+
+    def __init__(self, key, candidates):
+        self.key = key
+        self.candidates = candidates # lib -> CompiledFunction
+        self.first = self.last = next(iter(candidates.values()))
+        self.kind = self.first.kind
+        self.lock = threading.Lock()
+
+    # all the candidates split out the same grid invariants
+    def invariants(self, **kwargs):
+        return self.first.invariants(**kwargs)
+
+    # the report of the candidate we used most recently
+    @property
+    def report(self):
+        return self.last.report
+
+    # whether the candidate we used most recently is multithreaded
+    @property
+    def parallel(self):
+        return self.last.parallel
+
+    # the winner for each grid size seen so far, and whether it was timed tiled, with the
+    # timings, for inspection
+    def results(self):
+        with autotune_lock:
+            return {(size, tiled): result for (key, size, tiled), result in autotune_results.items() if key == self.key}
+
+    def sweep(self, names, invariants=None, /, **kwargs):
+        return sweep(self, names, invariants, kwargs)
+
+    def __call__(self, invariants=None, out=None, /, **kwargs):
+        if invariants is None:
+            invariants = self.invariants(**kwargs)
+        return self.choose(invariants, kwargs)(invariants, out, **kwargs)
+
+    # The fastest candidate for the size of the grid in kwargs, timing them the first time
+    # we see that size. By default each candidate is timed on autotune_points points,
+    # called directly; a caller that evaluates the grid some other way, e.g. eval_tiled
+    # tiling it onto several threads, passes run(fun, invariants, kwargs) to time it that
+    # way, and the number of points to time on.
+    def choose(self, invariants, kwargs, run=None, points=None):
+        shapes = [v.shape for v in (*kwargs.values(), *invariants.values()) if isinstance(v, np.ndarray)]
+        shape = max(shapes, key=math.prod, default=())
+        key = (self.key, math.prod(shape), run is not None)
+        # tune under our own lock, so other functions aren't held up while we time,
+        # and only look up and publish results under the global one
+        with self.lock:
+            with autotune_lock:
+                result = autotune_results.get(key)
+            if result is None:
+                result = self.tune(shape, invariants, kwargs, run, points or autotune_points)
+                with autotune_lock:
+                    result = autotune_results.setdefault(key, result)
+        self.last = self.candidates[result[0]]
+        return self.last
+
+    # time each candidate on the first rows of the grid, returning the winner and the timings
+    def tune(self, shape, invariants, kwargs, run, points):
+        if len(self.candidates) == 1:
+            return self.first.lib, {}
+        run = run or (lambda fun, invariants, kwargs: fun(invariants, None, **kwargs))
+        rows = max(1, points // max(1, shape[-1])) if shape else 1
+        def sample(values):
+            return {n: v[:rows] if getattr(v, "shape", None) == shape else v for n, v in values.items()}
+        invariants, kwargs = sample(invariants), sample(kwargs)
+        timings = {}
+        for lib, fun in self.candidates.items():
+            try:
+                run(fun, invariants, kwargs) # warm up, e.g. numba compiles here
+                times = []
+                for _ in range(autotune_repeats):
+                    start = time.perf_counter()
+                    run(fun, invariants, kwargs)
+                    times.append(time.perf_counter() - start)
+                timings[lib] = min(times)
+            except Exception as e:
+                print(f"autotune: {lib} failed: {e}")
+        winner = min(timings, key=timings.get) if timings else self.first.lib
+        print(f"autotune chose {winner} for {size_name(shape)}:",
+              ", ".join(f"{lib} {t*1000:.2f} ms" for lib, t in timings.items()))
+        return winner, timings
+
+def size_name(shape):
+    return "x".join(str(n) for n in shape) or "scalar"
+
+# generate code for expr, returning a tuple of the code object, the name of
+# the top-level function it defines, whether that function takes a pool, the source,
+# and the number of temporaries the buffer pool planned
+def codegen_fun(expr, arg_names, codegen, inplace=False, masked=False):
+
+    # the top-level generated function takes a BufferPool and an output array
+    # ahead of the arguments; these are not Mathics variables so don't go in the Scope
+    pool_names = ["__pool", "__out"] if codegen != "str" else []
+
+    if codegen in ("ast", "scope"):
+        module = None
+        if codegen == "ast":
+            try:
+                ctx = FlatCtx([*pool_names, *arg_names], masked)
+                module = ctx.emit(ctx.to_python_expr(expr))
+            except ResolveError as e:
+                print(f"using Scope for variables: {e}")
+        if module is None:
+            scope_vars = [(n, load(n)) for n in arg_names]
+            ctx = AstCtx("compiled", True, None, [*pool_names, *arg_names], scope_vars)
+            ctx.append_stmt(expr)
+            dummy = AstCtx("dummy")
+            ctx.emit(dummy)
+            module = dummy.stmts_to_module()
+        temporaries = 0
+        if inplace:
+            with util.Timer("plan buffers"):
+                temporaries = pool.use_buffer_pool(module, globals())
+            module = ast.fix_missing_locations(module)
+        code = compile(module, "<demo_compile>", "exec")
+        source = ast.unparse(module)
+    else:
+        ctx = Ctx("compiled", True, None, arg_names, zip(arg_names, arg_names))
+        ctx.append_stmt(expr)
+
+        # TODO: hokey - rework
+        dummy = Ctx("dummy")
+        ctx.emit(dummy)
+        source = dummy.stmts_to_string()
+        code = compile(source, "<demo_compile>", "exec")
+        temporaries = 0
+
+    return code, ctx.name, bool(pool_names), source, temporaries
+
+# the code for a point function for jit.Kernel, or None if numba can't compile expr
+def codegen_kernel(expr, arg_names):
+    try:
+        ctx = FlatCtx(arg_names)
+        module = jit.scalarize(ctx.emit(ctx.to_python_expr(expr)))
+    except (ResolveError, jit.Unsupported) as e:
+        print(f"using numpy instead of numba: {e}")
+        return None
+    return compile(module, "<demo_kernel>", "exec"), ctx.name, False, ast.unparse(module)
+
+# a numexpr expression string for expr, or None if numexpr can't evaluate it
+def codegen_numexpr(expr, arg_names):
+    try:
+        ctx = FlatCtx(arg_names)
+        return fused.translate(ctx.emit(ctx.to_python_expr(expr)))
+    except (ResolveError, fused.Unsupported) as e:
+        print(f"using numpy instead of numexpr: {e}")
+        return None
+
+# the top-level function defined by what codegen_fun generated
+def exec_code(evaluation, generated):
+    code, name = generated[:2]
+    # generated code runs with our globals, plus pointwise for heads we can't compile
+    namespace = dict(globals(), pointwise=Pointwise(evaluation))
+    ns = {}
+    exec(code, namespace, ns)
+    return ns[name]
+
+# whether what codegen_fun generated calls pointwise
+def uses_pointwise(generated):
+    def names(code):
+        yield from code.co_names
+        for c in code.co_consts:
+            if isinstance(c, types.CodeType):
+                yield from names(c)
+    return "pointwise" in names(generated[0])
+
+# make a Python function from what codegen_fun generated
+def load_fun(evaluation, generated):
+
+    compiled = exec_code(evaluation, generated)
+    takes_pool = generated[2]
+    buffers = pool.BufferPool()
 
     # top-level compiled function expects a scope, so we supply None
     # TODO: cleaner way to do this?
-    def fun(**kwargs):
-        result = ns[ctx.name](None, **kwargs)
+    def fun(out=None, /, **kwargs):
+        pool_args = (buffers, out) if takes_pool else ()
+        result = compiled(None, *pool_args, **kwargs)
         #print("xxx result", type(result), result.shape, result.dtype)
+        if out is not None and result is not out:
+            out[...] = result
+            result = out
         return result
 
     return fun
-
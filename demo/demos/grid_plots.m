@@ -0,0 +1,11 @@
+Grid[{{
+    ComplexPlot3D[(z^2 + 1) / (z^2 - 1), {z, -2 - 2 I, 2 + 2 I}, PlotRange -> {Automatic, Automatic, {0, 6}}],
+    ParametricPlot3D[
+        {Cos[u] (3 + Cos[v]), Sin[u] (3 + Cos[v]), Sin[v]},
+        {u, 0, 2 Pi}, {v, 0, 2 Pi},
+        PlotPoints -> {60, 30}
+    ]
+}, {
+    DensityPlot[Sin[x] Cos[y], {x, -3, 3}, {y, -3, 3}],
+    ContourPlot[Sin[x] Cos[y], {x, -3, 3}, {y, -3, 3}]
+}}]
@@ -23,7 +23,6 @@ Grid[{{
     ListStepPlot[{1, 1, 2, 3, 5, 8, 13, 21}]
 }, {
     (* TODO: axes should be centered; maybe use plotly native polar plot for this? *)
-    (* Interactive speed is marginal for this plot *)
     Manipulate[
         PolarPlot[
             Sqrt[t*a],
@@ -80,7 +79,6 @@ Grid[{{
                 {z = 0, i, freq, amp},
                 freq = 1;
                 amp = 1;
-                (* TODO: n==0 doesn't work - need to accept scalar z=0 in plot and promote to array *)
                 For[i = 1, i <= n, i++,
                     z += amp * Sin[freq x] * Cos[freq y];
                     freq *= fmul;
@@ -91,7 +89,7 @@ Grid[{{
             (* TODO: Pi doesn't work - I think we need to N[...] these exprs *)
             {x, -3, 3}, {y, -3, 3}
         ],
-        {{n,6}, 1, 10, 1},
+        {{n,6}, 0, 10, 1},
         {{fmul,2}, 1, 3, 0.1},
         {{adiv,2}, 1, 3, 0.1}
     ]
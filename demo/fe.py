@@ -21,9 +21,16 @@ parser.add_argument("--fe", choices=["shell", "browser", "jupyter"], default="sh
 parser.add_argument("--browser", choices=["webview", "webbrowser"], default="webview")
 parser.add_argument("--run", choices=["demos","tests","timing","dev"], default=None)
 parser.add_argument("--dev", type=str, default=None)
+parser.add_argument("--compile-cache", type=str, default=None, metavar="DIR",
+                    help="directory for a compiled code cache shared across sessions")
 parser.add_argument("demo", type=str, default=None, nargs="?")
 args = parser.parse_args()
 
+if args.compile_cache:
+    import codecache
+    import compile
+    compile.disk_cache = codecache.DiskCache(args.compile_cache, compile.disk_cache_bytes)
+
 run = dict(
 
     demos = [
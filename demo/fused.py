@@ -0,0 +1,120 @@
+"""
+numexpr backend for compiled functions.
+
+Arithmetic and elementwise functions like Sin[(x^2+y^2)*a] / Sqrt[x^2+y^2+1] * b
+are evaluated by the numpy backend one operation at a time, each one making a pass
+over the grid and producing a grid-sized temporary. numexpr instead evaluates the
+whole expression in one pass, block by block so that its temporaries stay in cache,
+using several threads.
+
+With lib="numexpr" demo_compile translates the ast that compile.FlatCtx generates
+for the expression into a single numexpr expression string, if everything in it
+is something numexpr supports. Otherwise, e.g. for Module and For, special functions
+from scipy, or pointwise evaluation through Mathics, the numpy version of the
+function is used instead. numexpr is optional, and only imported when needed.
+"""
+
+import ast
+import functools
+import math
+
+class Unsupported(Exception):
+    pass
+
+# numpy functions that numexpr has under the same name
+functions = {
+    "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh",
+    "exp", "log", "sqrt", "abs", "real", "imag", "where",
+}
+
+constants = {
+    "math.pi": math.pi,
+    "math.e": math.e,
+    "np.pi": math.pi,
+    "np.e": math.e,
+}
+
+class Translate(ast.NodeTransformer):
+
+    def visit_Call(self, node):
+        node.args = [self.visit(a) for a in node.args] # but not node.func, which is not a constant
+        fun = ast.unparse(node.func)
+
+        # sum([a, b, c]) -> a + b + c, and likewise math.prod
+        if fun in ("sum", "math.prod") and len(node.args) == 1 and isinstance(node.args[0], ast.List):
+            op = ast.Add if fun == "sum" else ast.Mult
+            return functools.reduce(lambda a, b: ast.BinOp(a, op(), b), node.args[0].elts)
+
+        # compile.arctan dispatches on the number of arguments
+        if fun == "arctan" and len(node.args) in (1, 2):
+            name = "arctan" if len(node.args) == 1 else "arctan2"
+            return ast.Call(ast.Name(name, ast.Load()), node.args, [])
+
+        # and so does compile.log
+        if fun == "log" and len(node.args) == 1:
+            return ast.Call(ast.Name("log", ast.Load()), node.args, [])
+
+        if fun.startswith("np.") and fun[3:] in functions:
+            return ast.Call(ast.Name(fun[3:], ast.Load()), node.args, [])
+
+        raise Unsupported(f"{fun} is not supported")
+
+    def visit_Attribute(self, node):
+        name = ast.unparse(node)
+        if name not in constants:
+            raise Unsupported(f"{name} is not supported")
+        return ast.Constant(constants[name])
+
+# Translate a module generated by compile.FlatCtx into a numexpr expression string.
+# Raises Unsupported unless the function it defines is a single return of an
+# expression that numexpr can evaluate.
+def translate(module):
+    fdef = module.body[0]
+    if len(fdef.body) != 1 or not isinstance(fdef.body[0], ast.Return):
+        raise Unsupported("statements are not supported")
+    value = Translate().visit(fdef.body[0].value)
+    for node in ast.walk(value):
+        if isinstance(node, (ast.List, ast.Lambda, ast.IfExp, ast.Subscript)):
+            raise Unsupported(f"{type(node).__name__} is not supported")
+    return ast.unparse(value)
+
+# whether numexpr can be used; we only tell the user it isn't installed once
+@functools.cache
+def available():
+    try:
+        import numexpr
+        return True
+    except ImportError:
+        print("numexpr is not installed, using numpy")
+        return False
+
+class Function:
+
+    # numexpr evaluates on its own threads, so callers shouldn't split
+    # the grid into tiles on their own threads
+    parallel = True
+
+    # source is the numexpr expression string, and fallback is the numpy
+    # version of the same function, which we use if numexpr can't evaluate it
+    def __init__(self, source, fallback):
+        import numexpr
+        self.numexpr = numexpr
+        self.source = source
+        self.fallback = fallback
+        self.failed = False
+
+    def __call__(self, out=None, /, **kwargs):
+        if not self.failed:
+            try:
+                return self.evaluate(out, kwargs)
+            except (NotImplementedError, TypeError, ValueError, KeyError, SyntaxError) as e:
+                print(f"numexpr can't evaluate this, using numpy: {e}")
+                self.failed = True
+        return self.fallback(out, **kwargs)
+
+    def evaluate(self, out, values):
+        result = self.numexpr.evaluate(self.source, local_dict=values)
+        if out is not None:
+            out[...] = result
+            result = out
+        return result
@@ -15,6 +15,7 @@ from mathics.core.load_builtin import add_builtins
 import layout as lt
 import mcs
 import mode
+import plot
 import util
 
 #
@@ -90,13 +91,26 @@ def layout_ManipulateBox(fe, manipulate_expr):
         return spec
     sliders = [slider(spec) for spec in slider_specs]
 
+    # if the target is something that has a fast path, e.g. Plot3D or Plot, this compiles it once
+    # with the slider names as parameters so that each slider move is just a call
+    # to the compiled function, with no Mathics evaluation or boxing
+    fast_eval = plot.demo_manipulate_plot(fe.session.evaluation, target_expr, [s.name for s in sliders])
+
     # compute a layout for an expr given a set of values
     # this is the callback for this Manipulate to update the target with new values
     def eval_and_layout(values):
+        values = {s.name: a for s, a in zip(sliders, values)}
+        if fast_eval:
+            expr = fast_eval(values)
+            with util.Timer("layout"):
+                if expr.head == mcs.SymbolGraphics:
+                    layout = layout_GraphicsBox(fe, expr)
+                else:
+                    layout = layout_Graphics3DBox(fe, expr)
+            return layout
         # TODO: always Global?
         # TODO: always Real?
         # TODO: best order for replace_vars and eval?
-        values = {s.name: a for s, a in zip(sliders, values)}
         with util.Timer("replace and eval"):
             expr = target_expr.replace_vars({"Global`"+n: mcs.Real(v) for n, v in values.items()})
             expr = expr.evaluate(fe.session.evaluation)
@@ -179,7 +193,9 @@ def process_options(fe, expr, dim):
         elif sym == mcs.SymbolColorFunction:
             # TODO: for some reason value is coming through with literal quotes?
             # TODO: what if differs from PlotLegends?
-            options.colorscale = value[1:-1]
+            # TODO: ColorFunction -> Automatic, as from DensityPlot, uses the default for now
+            if isinstance(value, str) and value.startswith('"'):
+                options.colorscale = value[1:-1]
         elif sym == mcs.SymbolImageSize:
             # TODO: separate width, height
             if not isinstance(value, str) and not isinstance(value, mcs.Expression):
@@ -218,6 +234,10 @@ def collect_graphics(expr):
     # numpy array of point coordinates
     points = []
 
+    # list of rasters, each represented by a tuple of a numpy array of values, whose
+    # rows go up in y, and the ((xmin, ymin), (xmax, ymax)) that it covers
+    rasters = []
+
     # options we ignore for now because not implemented
     tbd = set(["System`Hue"])
 
@@ -230,7 +250,15 @@ def collect_graphics(expr):
             ijks.append([i+1,i+2,i+3]) # ugh - 1-based to match GraphicsComplex Polygon
 
         elif g.head == mcs.SymbolLine or g.head == mcs.SymbolLineBox or g.head == mcs.SymbolLine3DBox:
-            value = g.elements[0].to_python()
+            # lines from demo_eval_Plot are one NumpyArrayListExpression, or a List of them,
+            # and those from ContourPlot are one NumpyArrayListExpression of many lines
+            value = g.elements[0]
+            nales = value.elements if value.head == mcs.SymbolList and not isinstance(value, mcs.NumpyArrayListExpression) else [value]
+            if all(isinstance(v, mcs.NumpyArrayListExpression) for v in nales):
+                for v in nales:
+                    lines.extend(v.value if v.value.ndim == 3 else [v.value] if len(v.value) else [])
+                return
+            value = value.to_python()
             if len(value) and len(value[0]) and isinstance(value[0][0], (tuple,list)):
                 for line in value:
                     lines.append(np.array(line))
@@ -241,8 +269,17 @@ def collect_graphics(expr):
             ps = g.elements[0].value
             points.extend(ps)
 
+        elif g.head == mcs.SymbolRaster:
+            values = g.elements[0]
+            values = values.value if isinstance(values, mcs.NumpyArrayListExpression) else np.array(values.to_python(), float)
+            bounds = g.elements[1].to_python() if len(g.elements) > 1 else ((0, 0), values.shape[::-1])
+            rasters.append((values, bounds))
+
         elif g.head == mcs.SymbolGraphicsComplex:
 
+            # indices in this GraphicsComplex are relative to its own points,
+            # which follow those of any earlier ones, e.g. one per surface from Plot3D
+            offset = len(xyzs)
             with util.Timer("xyzs"):
                 xyzs.extend(g.elements[0].value)
 
@@ -257,14 +294,14 @@ def collect_graphics(expr):
                             ngon = polys.value.shape[1]
                             for i in range(1, ngon-1):
                                 inx = [0, i, i+1]
-                                tris = polys.value[:, inx]
+                                tris = polys.value[:, inx] + offset
                                 ijks.extend(tris)
 
                     else:
                         with util.Timer("ijks from mathics List of polys"):
                             for poly in polys.elements:
                                 for j, k in zip(poly.elements[1:-1], poly.elements[2:]):
-                                    ijks.append([poly.elements[0].value, j.value, k.value])
+                                    ijks.append([poly.elements[0].value + offset, j.value + offset, k.value + offset])
 
                 else:
                     raise Exception(f"Unknown head {c.head} in GraphicsComplex")
@@ -298,22 +335,22 @@ def collect_graphics(expr):
             ijks = np.array(ijks) - 1 # ugh - indices in Polygon are 1-based
     points = np.array(points)
 
-    return xyzs, ijks, lines, points
+    return xyzs, ijks, lines, points, rasters
 
 
 # dim=2, mode.plot2d
 def layout_GraphicsBox(fe, expr):
-    xyzs, ijks, lines, points = collect_graphics(expr)
+    xyzs, ijks, lines, points, rasters = collect_graphics(expr)
     options = process_options(fe, expr, dim=2)
     # TODO: xyzs, ijks in 2d mode?
-    figure = mode.plot2d(lines, points, options)
+    figure = mode.plot2d(lines, points, options, rasters)
     layout = mode.graph(figure, options.height)
     return layout
 
 # dim=3, mode.plot3d
 def layout_Graphics3DBox(fe, expr):
     options = process_options(fe, expr, dim=3)
-    xyzs, ijks, lines, points = collect_graphics(expr)
+    xyzs, ijks, lines, points, rasters = collect_graphics(expr)
     figure = mode.plot3d(xyzs, ijks, lines, points, options)
     layout = mode.graph(figure, options.height)
     return layout
@@ -0,0 +1,203 @@
+"""
+Numba backend for compiled functions.
+
+The numpy backend evaluates one operation at a time over the whole grid, so a Module
+with a For loop, like the fractal landscape in plots.m, runs a Python-level loop whose
+body makes several passes over grid-sized arrays on every iteration. With lib="numba"
+demo_compile instead compiles the function for a single point: scalarize rewrites the
+ast generated by compile.FlatCtx so that it works on scalars, e.g. np.where becomes
+a conditional expression and sum([a, b]) becomes a + b. Kernel jit-compiles that with
+numba and runs it over the grid in a parallel prange loop that writes each result
+straight into the output array, so loops run at native speed with no temporaries.
+
+numba is optional, and is only imported when the first kernel is made. If it is
+not installed, or the expression uses something numba can't compile (special
+functions from scipy, pointwise evaluation through Mathics, ...), the numpy version
+of the function is used instead.
+"""
+
+import ast
+import functools
+import numpy as np
+
+class Unsupported(Exception):
+    pass
+
+# functions that numba can compile for scalars, by module
+supported = {
+    "np": {
+        "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2",
+        "sinh", "cosh", "tanh", "exp", "log", "sqrt", "abs", "real", "imag", "where", "e", "pi",
+    },
+    "math": {"pi", "e", "prod"},
+}
+
+def attribute(module, name):
+    return ast.Attribute(ast.Name(module, ast.Load()), name, ast.Load())
+
+class Scalarize(ast.NodeTransformer):
+
+    # Module locals without an initial value, and the values of For loops, start out as
+    # None, which numba would have to type as Optional, if it can type them at all, so
+    # we leave them unassigned; everything numba can compile assigns them before use
+    def visit_Assign(self, node):
+        if isinstance(node.value, ast.Constant) and node.value.value is None:
+            return ast.Pass()
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        fun = ast.unparse(node.func)
+
+        # sum([a, b, c]) -> a + b + c, and likewise math.prod
+        if fun in ("sum", "math.prod") and len(node.args) == 1 and isinstance(node.args[0], ast.List):
+            op = ast.Add if fun == "sum" else ast.Mult
+            return functools.reduce(lambda a, b: ast.BinOp(a, op(), b), node.args[0].elts)
+
+        # np.where only evaluates both branches because it works on whole arrays
+        if fun == "np.where" and len(node.args) == 3:
+            cond, a, b = node.args
+            return ast.IfExp(cond, a, b)
+
+        # compile.arctan dispatches on the number of arguments
+        if fun == "arctan" and len(node.args) in (1, 2):
+            node.func = attribute("np", "arctan" if len(node.args) == 1 else "arctan2")
+            return node
+
+        # and so does compile.log
+        if fun == "log" and len(node.args) == 1:
+            node.func = attribute("np", "log")
+            return node
+
+        if not (isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name)
+                and node.func.attr in supported.get(node.func.value.id, ())):
+            raise Unsupported(f"{fun} is not supported")
+        return node
+
+# Rewrite a module generated by compile.FlatCtx, which defines one function that
+# takes a scope argument and then the arguments, into one that defines the same
+# function of scalar arguments that numba can compile.
+# Raises Unsupported if there is anything in it that numba can't compile.
+def scalarize(module):
+
+    module = Scalarize().visit(module)
+    fdef = module.body[0]
+    fdef.args.args = fdef.args.args[1:] # the unused scope argument
+
+    # everything left must be a local or a supported module attribute
+    local_names = set(a.arg for a in fdef.args.args)
+    local_names |= set(n.id for n in ast.walk(fdef) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store))
+    for node in ast.walk(fdef):
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.attr in supported.get(node.value.id, ())):
+                raise Unsupported(f"{ast.unparse(node)} is not supported")
+        elif isinstance(node, ast.Name) and node.id not in local_names and node.id not in supported:
+            raise Unsupported(f"{node.id} is not supported")
+        elif isinstance(node, (ast.List, ast.Lambda)):
+            raise Unsupported(f"{type(node).__name__} is not supported")
+
+    return ast.fix_missing_locations(module)
+
+# whether numba can be used; we only tell the user it isn't installed once
+@functools.cache
+def available():
+    try:
+        import numba
+        return True
+    except ImportError:
+        print("numba is not installed, using numpy")
+        return False
+
+# The loop over the grid. For a point function of three arguments of which
+# the first and third are arrays this is
+#
+#     def kernel(out, a0, a1, a2):
+#         for i in numba.prange(out.shape[0]):
+#             out[i] = point(a0[i], a1, a2[i])
+#
+# Arrays are passed flattened, so the same kernel works for any shape of grid.
+def kernel_module(arrays):
+    names = [f"a{i}" for i in range(len(arrays))]
+    index = ast.Name("i", ast.Load())
+    point_args = [
+        ast.Subscript(ast.Name(n, ast.Load()), index, ast.Load()) if is_array else ast.Name(n, ast.Load())
+        for n, is_array in zip(names, arrays)
+    ]
+    out = ast.Subscript(ast.Name("out", ast.Load()), index, ast.Store())
+    size = ast.Subscript(attribute("out", "shape"), ast.Constant(0), ast.Load())
+    loop = ast.For(
+        ast.Name("i", ast.Store()), ast.Call(attribute("numba", "prange"), [size], []),
+        [ast.Assign([out], ast.Call(ast.Name("point", ast.Load()), point_args, []))], []
+    )
+    args = ast.arguments(
+        posonlyargs=[], args=[ast.arg(n) for n in ["out", *names]],
+        kwonlyargs=[], kw_defaults=[], defaults=[]
+    )
+    fdef = ast.FunctionDef("kernel", args, [loop], decorator_list=[], returns=None, type_params=[])
+    return ast.fix_missing_locations(ast.Module([fdef], type_ignores=[]))
+
+class Kernel:
+
+    # compiled functions run the prange loop on numba's own threads,
+    # so callers shouldn't split the grid into tiles on their own threads
+    parallel = True
+
+    # point is the Python function generated by scalarize, and fallback is the numpy
+    # version of the same function, which we use if numba can't compile point
+    def __init__(self, point, fallback):
+        import numba
+        self.numba = numba
+        code = point.__code__
+        self.arg_names = code.co_varnames[:code.co_argcount]
+        # numpy semantics for things like division by zero, instead of exceptions
+        self.point = numba.njit(error_model="numpy")(point)
+        self.fallback = fallback
+        self.kernels = {} # which arguments are arrays -> compiled kernel
+        self.failed = False
+
+    def kernel(self, arrays):
+        kernel = self.kernels.get(arrays)
+        if kernel is None:
+            ns = {}
+            exec(compile(kernel_module(arrays), "<demo_kernel>", "exec"), dict(numba=self.numba, point=self.point), ns)
+            kernel = self.kernels[arrays] = self.numba.njit(parallel=True, error_model="numpy")(ns["kernel"])
+        return kernel
+
+    def __call__(self, out=None, /, **kwargs):
+        if not self.failed:
+            try:
+                return self.evaluate(out, [kwargs[n] for n in self.arg_names])
+            except self.numba.core.errors.NumbaError as e:
+                print(f"numba can't compile this, using numpy: {str(e).splitlines()[0]}")
+                self.failed = True
+        return self.fallback(out, **kwargs)
+
+    def evaluate(self, out, args):
+
+        # ints as floats, so that e.g. a slider going from 1 to 1.5 doesn't need a new kernel
+        args = [float(a) if isinstance(a, int) else a for a in args]
+        arrays = tuple(isinstance(a, np.ndarray) and a.shape != () for a in args)
+        if not any(arrays):
+            result = self.point(*(a.item() if hasattr(a, "item") else a for a in args))
+            if out is not None:
+                out[...] = result
+                return out
+            return result
+
+        shape = np.broadcast_shapes(*(a.shape for a, is_array in zip(args, arrays) if is_array))
+        args = [np.ascontiguousarray(np.broadcast_to(a, shape)).reshape(-1) if is_array else a for a, is_array in zip(args, arrays)]
+
+        # the type of the result is the same at every point, so we find it from the first
+        dtype = np.asarray(self.point(*(a[0] if is_array else a for a, is_array in zip(args, arrays)))).dtype
+
+        # write straight into out if we can
+        if out is not None and out.shape == shape and out.dtype == dtype and out.flags.c_contiguous:
+            result = out
+        else:
+            result = np.empty(shape, dtype)
+        self.kernel(arrays)(result.reshape(-1), *args)
+        if out is not None and result is not out:
+            out[...] = result
+            result = out
+        return result
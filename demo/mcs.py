@@ -7,7 +7,7 @@ import os
 #
 
 from mathics.core.symbols import Symbol, SymbolList, SymbolPlus, SymbolTimes, SymbolPower, SymbolList
-from mathics.core.systemsymbols import SymbolSin, SymbolCos, SymbolArcTan, SymbolSqrt, SymbolAbs, SymbolGamma, \
+from mathics.core.systemsymbols import SymbolSin, SymbolCos, SymbolTan, SymbolExp, SymbolLog, SymbolArcTan, SymbolSqrt, SymbolAbs, SymbolGamma, \
     SymbolRule, SymbolI, SymbolE, SymbolPi, SymbolRow, SymbolGrid, SymbolMakeBoxes, \
     SymbolTraditionalForm, SymbolStandardForm, SymbolMathMLForm, SymbolOutputForm, SymbolTeXForm, \
     SymbolRowBox, SymbolFractionBox, SymbolSqrtBox, SymbolSuperscriptBox, SymbolHold
@@ -17,6 +17,7 @@ from mathics.builtin.box.graphics import LineBox
 from mathics.builtin.box.expression import BoxExpression
 
 from mathics.core.atoms import Integer, Real, Complex, String
+from mathics.core.convert.python import from_python
 from mathics.core.list import ListExpression
 from mathics.core.expression import Expression
 from mathics.session import MathicsSession, Evaluation
@@ -52,14 +53,22 @@ SymbolAspectRatio = Symbol("System`AspectRatio")
 SymbolManipulate = Symbol("System`Manipulate") # TODO: move to System
 SymbolManipulateBox = Symbol("System`ManipulateBox") # TODO: move to System
 SymbolGraphics3D = Symbol("System`Graphics3D")
+SymbolPlot3D = Symbol("System`Plot3D")
+SymbolComplexPlot3D = Symbol("System`ComplexPlot3D")
+SymbolParametricPlot3D = Symbol("System`ParametricPlot3D")
+SymbolDensityPlot = Symbol("System`DensityPlot")
+SymbolContourPlot = Symbol("System`ContourPlot")
 SymbolGraphics3DBox = Symbol("System`Graphics3DBox")
 SymbolGraphics = Symbol("System`Graphics")
 SymbolGraphicsBox = Symbol("System`GraphicsBox")
 SymbolGraphicsComplex = Symbol("System`GraphicsComplex") # TODO: move to System
 SymbolLine = Symbol("System`Line")
 SymbolPoint = Symbol("System`Point")
+SymbolHue = Symbol("System`Hue")
+SymbolTrue = Symbol("System`True")
 SymbolPointBox = Symbol("System`PointBox")
 SymbolPolygon = Symbol("System`Polygon")
+SymbolRaster = Symbol("System`Raster")
 SymbolPolygon3DBox = Symbol("System`Polygon3DBox")
 SymbolLineBox = Symbol("System`LineBox")
 SymbolLine3DBox = Symbol("System`Line3DBox")
@@ -74,6 +83,9 @@ SymbolSequence = Symbol("System`Sequence")
 SymbolGreater = Symbol("System`Greater")
 SymbolLessEqual = Symbol("System`LessEqual")
 SymbolIf = Symbol("System`If")
+SymbolN = Symbol("System`N")
+SymbolRe = Symbol("System`Re")
+SymbolIm = Symbol("System`Im")
 SymbolModule = Symbol("System`Module")
 SymbolCompoundExpression = Symbol("System`CompoundExpression")
 SymbolSet = Symbol("System`Set")
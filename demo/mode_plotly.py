@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 
+import numpy as np
 import plotly.graph_objects as go
 
 import util
@@ -23,10 +24,22 @@ def axis(show, range, title):
     return axis
 
 @util.Timer("plot2d")
-def plot2d(lines, points, options: Options):
+def plot2d(lines, points, options: Options, rasters=()):
 
     data = []
 
+    # add rasters, e.g. from DensityPlot, first so that everything else is drawn over them
+    for values, ((xmin, ymin), (xmax, ymax)) in rasters:
+        with util.Timer("heatmap"):
+            ny, nx = values.shape
+            dx, dy = (xmax - xmin) / nx, (ymax - ymin) / ny
+            heatmap = go.Heatmap(
+                z = values, x0 = xmin + dx / 2, dx = dx, y0 = ymin + dy / 2, dy = dy,
+                showscale=options.showscale, colorscale=options.colorscale, colorbar=dict(thickness=10),
+                hoverinfo="none"
+            )
+            data.append(heatmap)
+
     # add points
     if points is not None and len(points):
         with util.Timer("scatter points"):
@@ -37,16 +50,19 @@ def plot2d(lines, points, options: Options):
             #figure.add_trace(scatter_points)
             data.append(scatter_points)
 
-    # add lines
+    # add lines, all in one trace with a nan point between successive lines, which plotly
+    # leaves a gap at; a trace per line is slow when there are many of them, e.g. the
+    # segments of the contour lines from ContourPlot
     if lines is not None and len(lines):
         with util.Timer("scatter lines"):
-            for line in lines:
-                scatter_lines = go.Scatter(
-                    x = line[:,0], y = line[:,1],
-                    mode='lines', line=dict(color='black', width=1)
-                )
-                #figure.add_trace(scatter_lines)
-                data.append(scatter_lines)
+            gap = np.full((1, 2), np.nan)
+            xys = np.concatenate([part for line in lines for part in (np.asarray(line, float)[:,:2], gap)])
+            scatter_lines = go.Scatter(
+                x = xys[:,0], y = xys[:,1],
+                mode='lines', line=dict(color='black', width=1)
+            )
+            #figure.add_trace(scatter_lines)
+            data.append(scatter_lines)
 
     # plot layout
     layout = go.Layout(
@@ -9,13 +9,26 @@ Generates Graphics3D that contains GraphicsComplex, which is an efficient
 representation of graphics objects like meshes. As far as I know this, while standard
 Mathematica, is not yet understood by any part of Mathics, although it is understood
 by the demo layout functions in graphics.py. 
+
+The same grid evaluation also computes ComplexPlot3D, ParametricPlot3D,
+DensityPlot and ContourPlot, the latter two as a Raster and contour Lines.
+
+Likewise demo_eval_Plot evaluates Plot, LogPlot, PolarPlot, and ParametricPlot
+by compiling the functions and sampling them in one numpy call, producing Lines
+whose points are NumpyArrayListExpressions.
 """
 
 import collections 
+import concurrent.futures
 import itertools
 import math
 import numpy as np
 import os
+import threading
+
+import mathics.builtin.drawing.plot
+from mathics.core.builtin import Builtin
+from mathics.core.load_builtin import add_builtins
 
 import compile
 import mcs
@@ -33,69 +46,967 @@ def demo_eval_plot3d(
     evaluation: mcs.Evaluation,
     options: dict,
 ):
-    # TODO: handle multiple functions
+    # this is called for Plot3D, DensityPlot, and the _Plot3D subclasses below,
+    # which all take the same arguments
+    name = self.get_name()
+
+    # the components of each surface of a ParametricPlot3D are compiled as one list
+    components = functions
+    if name == "System`ParametricPlot3D":
+        components = parametric_components(functions)
+        if components is None:
+            return None
 
     # compile the function
-    # In the case of Manipulate we are doing this compilation on every slider move.
-    # We could lift that compilation into ManipulateBox, but that would require
-    # somehow getting it through Plot3D to here. Or we could cache the result.
-    # But timings show that would be practically meaningless for performance,
-    # so better to spend effort elsewhere.
-    x_name, y_name = str(x).split("`")[-1], str(y).split("`")[-1]
-    with util.Timer("compile"):
-        fun = compile.demo_compile(evaluation, functions, [x_name, y_name]) # XXX
+    # Plot3D[{f1, f2, ...}, ...] is compiled as one function returning a list, so that
+    # the surfaces share the grid, and subexpressions they have in common are computed once.
+    # In the case of Manipulate we get here on every slider move, but demo_compile
+    # caches compiled functions so a re-plot of an expression that has already been
+    # compiled skips code generation. See also demo_manipulate_plot3d below,
+    # which avoids getting here at all for Manipulate.
+    x_name, y_name = compile.strip_context(x), compile.strip_context(y)
+    try:
+        with util.Timer("compile"):
+            fun = compile.demo_compile(evaluation, components, [x_name, y_name], real=True) # XXX
+        bounds = [float(numeric_value(b, evaluation)) for b in (xstart, xstop, ystart, ystop)]
+    except Exception as e:
+        # Mathics only has Plot3D and DensityPlot; the others are left unevaluated
+        if name in ("System`Plot3D", "System`DensityPlot"):
+            print(f"using Mathics {name}: {e}")
+            return mathics_eval_plot3d(self, functions, x, xstart, xstop, y, ystart, ystop, evaluation, options)
+        print(f"not evaluating {name}: {e}")
+        return None
+
+    ranges = (x_name, bounds[0], bounds[1], y_name, bounds[2], bounds[3])
+    if name == "System`ParametricPlot3D":
+        return parametric_plot3d(fun, {}, *ranges, options)
+    if name in ("System`DensityPlot", "System`ContourPlot"):
+        return density_plot(name, fun, {}, *ranges, options)
+    return surface_plot3d(fun, *ranges, options)
+
+# the value of a bound of a plot range, which may be something like 2 Pi
+def numeric_value(expr, evaluation):
+    return mcs.Expression(mcs.SymbolN, expr).evaluate(evaluation).to_python()
+
+# Plot3D of a compiled function: refine adaptively unless we're given the number of plot points
+def surface_plot3d(fun, x_name, xstart, xstop, y_name, ystart, ystop, options):
+    max_recursion = options["System`MaxRecursion"].to_python()
+    if options["System`PlotPoints"].to_python() == "System`None" and isinstance(max_recursion, int) and max_recursion > 0:
+        return plot3d_adaptive(fun, {}, x_name, xstart, xstop, y_name, ystart, ystop, max_recursion, options)
+    return plot3d(fun, {}, x_name, xstart, xstop, y_name, ystart, ystop, options)
+
+# compute a Graphics3D by evaluating a compiled function fun on a grid
+# params supplies values for any arguments of fun other than x_name and y_name
+# if grid_cache is supplied the grid, and the values of any subexpressions of fun
+# that depend only on the grid, are cached there keyed by the grid spec
+def plot3d(fun, params, x_name, xstart, xstop, y_name, ystart, ystop, options, grid_cache=None):
 
-    # compute number of plot points nx, ny
-    # TODO: for now, here's where we supply a default of 200x200
+    nx, ny = grid_points(options)
+    xs, ys, zs = eval_grid(fun, params, x_name, xstart, xstop, nx, y_name, ystart, ystop, ny, grid_cache)
+
+    # reshape for GraphicsComplex
+    xyzs = np.stack([np.broadcast_to(xs, zs.shape), np.broadcast_to(ys, zs.shape), zs], axis=-1)
+    xyzs = xyzs.reshape(len(zs), -1, 3)                                                         # shape = (surfaces, nx*ny, 3)
+
+    return graphics3d(xyzs, [grid_quads(xs.shape)], options)
+
+#
+# The grid engine: evaluate a compiled function of two variables on a uniform grid in
+# one call, for Plot3D above and for ComplexPlot3D, ParametricPlot3D, DensityPlot and
+# ContourPlot below, which differ only in what they make of the values
+#
+
+# compute number of plot points nx, ny
+# TODO: for now, here's where we supply a default of 200x200
+def grid_points(options):
     pp = options["System`PlotPoints"].to_python()
     if not isinstance(pp, (tuple,list)):
         pp = [pp] * 2
     pp = [p if isinstance(p, (int,float)) else 200 for p in pp]
-    nx, ny = pp
+    return pp
+
+# Returns the grid arrays xs and ys, of shape (ny, nx), and the values computed by fun,
+# of shape (number of surfaces, ny, nx) - see surfaces.
+# params and grid_cache are as for plot3d
+def eval_grid(fun, params, x_name, xstart, xstop, nx, y_name, ystart, ystop, ny, grid_cache=None):
 
-    # compute xs and ys
-    xs = np.linspace(xstart.value, xstop.value, nx)
-    ys = np.linspace(ystart.value, ystop.value, ny)
-    xs, ys = np.meshgrid(xs, ys)
+    # compute xs and ys, and the grid-only parts of fun
+    spec = (xstart, xstop, nx, ystart, ystop, ny)
+    if grid_cache is not None and spec in grid_cache:
+        xs, ys, invariants = grid_cache[spec]
+    else:
+        xs = np.linspace(xstart, xstop, nx)
+        ys = np.linspace(ystart, ystop, ny)
+        xs, ys = np.meshgrid(xs, ys)
+        with util.Timer("compute invariants"):
+            invariants = fun.invariants(**{x_name: xs, y_name: ys})
+        if grid_cache is not None:
+            # sliders that control the plot range would otherwise grow this without bound
+            while len(grid_cache) >= grid_cache_size:
+                del grid_cache[next(iter(grid_cache))]
+            grid_cache[spec] = (xs, ys, invariants)
 
     # compute zs from xs and ys using compiled function
     with util.Timer("compute zs"):
-        zs = fun(**{x_name: xs, y_name: ys})
+        zs = eval_tiled(fun, invariants, {x_name: xs, y_name: ys}, params)
 
-    # sometimes expr gets compiled into something that returns a complex even though the imaginary part is 0
-    # TODO: check that imag is all 0?
-    # TODO: needed this for Hypergeometric - look into that
-    #assert np.all(np.isreal(zs)), "array contains complex values"
-    zs = np.real(zs)
+    return xs, ys, surfaces(fun, zs, xs.shape)
 
-    # reshape for GraphicsComplex
-    n = math.prod(xs.shape)
-    inxs = np.arange(n).reshape(xs.shape)                                                       # shape = (nx,ny)
-    quads = np.stack([inxs[:-1,:-1], inxs[:-1,1:], inxs[1:,1:], inxs[1:,:-1]]).T.reshape(-1, 4) # shape = ((nx-1)*(nx-1), 4)
-    xyzs = np.stack([xs, ys, zs]).transpose(1,2,0).reshape(-1,3)                                # shape = (nx*ny, 3)
+# quads joining the points of a grid of the given shape, as 0-based indices into the flattened grid
+def grid_quads(shape):
+    inxs = np.arange(math.prod(shape)).reshape(shape)
+    return np.stack([inxs[:-1,:-1], inxs[:-1,1:], inxs[1:,1:], inxs[1:,:-1]]).T.reshape(-1, 4)
 
-    # ugh - indices in Polygon are 1-based
-    quads += 1
+# the values zs computed by fun for a grid of the given shape, as an array of shape
+# (number of surfaces, *shape), whether fun is one function or a list of them
+def surfaces(fun, zs, shape):
+    zs = zs if isinstance(zs, (list, tuple)) else [zs]
+    # fun is compiled to compute just the real part, using complex arithmetic only
+    # where it needs to, e.g. for Hypergeometric1F1 of a complex argument
+    if fun.kind.complex:
+        zs = [np.real(z) for z in zs]
+    # the function may not depend on x and y, or may return a scalar in some cases,
+    # e.g. a Module that accumulates into z = 0 in a loop that runs no times
+    return np.stack([np.broadcast_to(z, shape) for z in zs])
+
+# construct a Graphics3D containing a GraphicsComplex for each surface, whose points
+# are xyzs[i], of shape (n, 3), and with a Polygon for each array of 0-based indices
+# into those points in polys; all of the surfaces have the same polygons
+def graphics3d(xyzs, polys, options):
 
-    # construct Graphics3D
     # TODO: use class from core
     # TODO: see how the rules get passed on in mathics.builtin.drawing.plot.eval_plot3d and emulate that
     rules = [mcs.Expression(mcs.SymbolRule, mcs.Symbol(n), v) for n, v in options.items()]
-    quads_expr = mcs.NumpyArrayListExpression(quads)
-    xyzs_expr = mcs.NumpyArrayListExpression(xyzs)
-    poly_expr = mcs.Expression(mcs.SymbolPolygon, quads_expr)
-    gc_expr = mcs.Expression(mcs.SymbolGraphicsComplex, xyzs_expr, poly_expr)
-    result = mcs.Expression(mcs.SymbolGraphics3D, gc_expr, *rules)
+    # ugh - indices in Polygon are 1-based
+    poly_exprs = [mcs.Expression(mcs.SymbolPolygon, mcs.NumpyArrayListExpression(p + 1)) for p in polys]
+    gc_exprs = [
+        mcs.Expression(mcs.SymbolGraphicsComplex, mcs.NumpyArrayListExpression(surface), *poly_exprs)
+        for surface in xyzs
+    ]
+    result = mcs.Expression(mcs.SymbolGraphics3D, mcs.ListExpression(*gc_exprs), *rules)
+
+    return result
+
+# number of grids to cache per Manipulate panel
+grid_cache_size = 4
+
+#
+# Tiled evaluation. numpy ufuncs release the GIL, so we can use multiple cores
+# by splitting the grid into tiles of rows and evaluating the compiled function on
+# each tile in a thread pool, each tile storing its part of one output array.
+# Tiles are sized so that the handful of temporaries for a tile stay in cache.
+#
+
+# number of threads; defaults to number of cores
+eval_threads = int(os.getenv("DEMO_THREADS", "0")) or os.cpu_count() or 1
+
+# target number of grid points per tile
+tile_points = int(os.getenv("DEMO_TILE_POINTS", "32768"))
+
+executor = None
+executor_lock = threading.Lock()
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(eval_threads, thread_name_prefix="demo-eval")
+        return executor
+
+# evaluate fun(invariants, **grid, **params), where grid supplies the grid arrays,
+# all of the same 2d shape; invariants may also contain arrays of that shape
+def eval_tiled(fun, invariants, grid, params):
+
+    shape = next(iter(grid.values())).shape
+    rows = max(1, tile_points // max(1, shape[-1]))
+
+    # with lib="auto" use the fastest backend, timing each the way we run it below,
+    # on enough of the grid to give every thread a tile
+    if isinstance(fun, compile.AutoFunction):
+        def run(fun, invariants, kwargs):
+            sample = {n: kwargs[n] for n in grid}
+            return eval_tiled(fun, invariants, sample, {n: v for n, v in kwargs.items() if n not in grid})
+        fun = fun.choose(invariants, {**grid, **params}, run, eval_threads * tile_points)
+
+    # a numba kernel already runs on several threads
+    if eval_threads <= 1 or shape[0] <= rows or fun.parallel:
+        return fun(invariants, **grid, **params)
+
+    # slice out the rows of a tile from every array that is the shape of the grid
+    def tile(values, i):
+        return {n: v[i:i+rows] if getattr(v, "shape", None) == shape else v for n, v in values.items()}
+    def eval_tile(i):
+        return fun(tile(invariants, i), None, **tile(grid, i), **tile(params, i))
+
+    # evaluate the first tile to find out the type of the result
+    # and whether it is actually a grid, as opposed to e.g. a constant
+    first = eval_tile(0)
+    if getattr(first, "shape", None) != (rows, *shape[1:]):
+        return fun(invariants, **grid, **params)
+    result = np.empty(shape, first.dtype)
+    result[:rows] = first
+
+    # Other tiles may come out as a different type, e.g. complex where a Pointwise
+    # fallback returns complex values for only some points. Those can't be stored
+    # in result, so we hand them back, and promote result once all tiles are done.
+    def store_tile(i):
+        value = np.asarray(eval_tile(i))
+        if not np.can_cast(value.dtype, result.dtype):
+            return i, value
+        result[i:i+rows] = value
+        return None
 
+    tiles = [get_executor().submit(store_tile, i) for i in range(rows, shape[0], rows)]
+    promoted = [t for t in (t.result() for t in tiles) if t is not None]
+    if promoted:
+        result = result.astype(np.result_type(result, *(value for _, value in promoted)))
+        for i, value in promoted:
+            result[i:i+rows] = value
     return result
 
+#
+# Adaptive mesh refinement for Plot3D. If PlotPoints isn't given, instead of a uniform
+# 200x200 grid we start with a coarse grid of adaptive_points x adaptive_points and
+# refine it as a quadtree, MaxRecursion times. At each level we evaluate the center
+# and edge midpoints of every cell under consideration in one call, and split the
+# cells where any of those differs from the bilinear interpolation of the corners by
+# more than adaptive_tolerance times the range of z over the coarse grid, or where
+# the function is finite at some of the points but not others. The child cells of
+# the split cells are considered at the next level, and have their corners already
+# computed. So flat regions stay coarse and detailed ones get the resolution of a
+# 200x200 grid with the default MaxRecursion of 2, or finer with more.
+#
+# Points are identified by their integer coordinates on the grid of the finest level,
+# so that cells share the points on their common edges. A cell whose neighbor was
+# split has the neighbor's points on their common edge, so each cell becomes a polygon
+# through all the points on its boundary, which leaves no cracks in the surface.
+# Polygons are grouped by number of sides, one Polygon of NumpyArrayListExpression
+# per group.
+#
+
+# size of the initial grid
+adaptive_points = int(os.getenv("DEMO_PLOT3D_ADAPTIVE_POINTS", "50"))
+
+# largest error of the bilinear interpolation across a cell that doesn't need splitting,
+# as a fraction of the range of z
+adaptive_tolerance = float(os.getenv("DEMO_PLOT3D_TOLERANCE", "0.002"))
+
+# upper bound on the number of points evaluated
+max_plot3d_points = int(os.getenv("DEMO_PLOT3D_MAX_POINTS", "100000"))
+
+# points are evaluated at most once, looked up by key in keys, which is kept sorted
+class AdaptiveGrid:
+
+    def __init__(self, fun, params, x_name, xstart, dx, y_name, ystart, dy, n):
+        self.fun = fun
+        self.params = params
+        self.x_name, self.xstart, self.dx = x_name, xstart, dx
+        self.y_name, self.ystart, self.dy = y_name, ystart, dy
+        self.n = n # number of points along each side of the finest grid
+        self.keys = np.empty(0, np.int64)
+        self.zs = None # shape (number of surfaces, len(keys))
+
+    def key(self, i, j):
+        return i.astype(np.int64) * self.n + j
+
+    def xys(self, keys):
+        i, j = np.divmod(keys, self.n)
+        return self.xstart + i * self.dx, self.ystart + j * self.dy
+
+    def find(self, keys):
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return pos, self.keys[pos] == keys
+
+    # evaluate the points at i, j that haven't already been evaluated, in one call
+    def evaluate(self, i, j):
+        keys = np.unique(self.key(i, j))
+        if len(self.keys):
+            keys = keys[~self.find(keys)[1]]
+        if not len(keys):
+            return
+        xs, ys = self.xys(keys)
+        with np.errstate(all="ignore"):
+            zs = self.fun(**{self.x_name: xs, self.y_name: ys}, **self.params)
+        zs = surfaces(self.fun, zs, xs.shape).astype(float)
+        keys = np.concatenate([self.keys, keys])
+        zs = zs if self.zs is None else np.concatenate([self.zs, zs], axis=1)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.zs = keys[order], zs[:, order]
+
+    def z(self, i, j):
+        return self.zs[:, self.find(self.key(i, j))[0]]
+
+    # the polygons through the points on the boundaries of cells of size s
+    # with lower corners at i, j, grouped by number of sides
+    def polygons(self, i, j, s):
+        t = np.arange(s)
+        bi = np.concatenate([t, np.full(s, s), s - t, np.zeros(s, int)])
+        bj = np.concatenate([np.zeros(s, int), t, np.full(s, s), s - t])
+        pos, found = self.find(self.key(i[:, None] + bi, j[:, None] + bj))
+        counts = found.sum(axis=1)
+        for count in np.unique(counts):
+            rows = counts == count
+            yield count, pos[rows][found[rows]].reshape(-1, count)
+
+def plot3d_adaptive(fun, params, x_name, xstart, xstop, y_name, ystart, ystop, max_recursion, options):
+
+    n = adaptive_points
+    s = 2 ** max_recursion # size of the initial cells, in units of the finest grid
+    grid = AdaptiveGrid(
+        fun, params,
+        x_name, xstart, (xstop - xstart) / ((n - 1) * s),
+        y_name, ystart, (ystop - ystart) / ((n - 1) * s),
+        (n - 1) * s + 1
+    )
+
+    # the initial grid, and the range of z of each surface that the tolerance is relative to
+    with util.Timer("compute initial grid"):
+        i, j = (a.reshape(-1) for a in np.meshgrid(np.arange(n - 1) * s, np.arange(n - 1) * s))
+        grid.evaluate(*(a.reshape(-1) for a in np.meshgrid(np.arange(n) * s, np.arange(n) * s)))
+        finite = np.isfinite(grid.zs)
+        with np.errstate(all="ignore"):
+            zscale = np.max(grid.zs, axis=1, initial=-np.inf, where=finite) - np.min(grid.zs, axis=1, initial=np.inf, where=finite)
+        zscale = np.where(np.isfinite(zscale) & (zscale > 0), zscale, 1.0)[:, None]
+
+    leaves = []
+    for level in range(max_recursion):
+        with util.Timer(f"refine level {level}"):
+            h = s // 2
+
+            # center and edge midpoints, and their bilinear interpolations from the corners
+            grid.evaluate(
+                np.concatenate([i + h, i + h, i, i + s, i + h]),
+                np.concatenate([j + h, j, j + h, j + h, j + s])
+            )
+            z00, z10, z01, z11 = grid.z(i, j), grid.z(i + s, j), grid.z(i, j + s), grid.z(i + s, j + s)
+            zs = np.stack([grid.z(i + h, j + h), grid.z(i + h, j), grid.z(i, j + h), grid.z(i + s, j + h), grid.z(i + h, j + s)])
+            interp = np.stack([(z00 + z10 + z01 + z11) / 4, (z00 + z10) / 2, (z00 + z01) / 2, (z10 + z11) / 2, (z01 + z11) / 2])
+            error = abs(zs - interp).max(axis=0) / zscale
+
+            # cells where the function is finite at only some of the points are split too,
+            # and a cell is split if it needs to be for any of the surfaces
+            finite = np.isfinite(np.concatenate([zs, [z00, z10, z01, z11]])).sum(axis=0)
+            error = np.where(finite == 9, error, np.where(finite == 0, 0, np.inf)).max(axis=0)
+
+            # split the cells with the largest errors first, while within the
+            # budget for the points of the 4 children of each
+            split = np.flatnonzero(error > adaptive_tolerance)
+            budget = max(0, (max_plot3d_points - len(grid.keys)) // 20)
+            if len(split) > budget:
+                split = split[np.argsort(-error[split], kind="stable")[:budget]]
+            keep = np.ones(len(i), bool)
+            keep[split] = False
+            leaves.append((i[keep], j[keep], s))
+            i = np.concatenate([i[split], i[split] + h, i[split], i[split] + h])
+            j = np.concatenate([j[split], j[split], j[split] + h, j[split] + h])
+            s = h
+    leaves.append((i, j, s))
+
+    # polygons through the points on the boundary of each leaf cell
+    with util.Timer("polygons"):
+        polys = collections.defaultdict(list)
+        for i, j, s in leaves:
+            for count, p in grid.polygons(i, j, s):
+                polys[count].append(p)
+        polys = [np.concatenate(p) for _, p in sorted(polys.items())]
+
+    xs, ys = grid.xys(grid.keys)
+    xyzs = np.stack([np.broadcast_to(xs, grid.zs.shape), np.broadcast_to(ys, grid.zs.shape), grid.zs], axis=-1)
+    return graphics3d(xyzs, polys, options)
+
+#
+# ComplexPlot3D, ParametricPlot3D, DensityPlot and ContourPlot, all on the grid engine
+#
+# ComplexPlot3D[f, {z, zmin, zmax}] plots Abs[f] over the complex grid z = x + I y,
+# which we compile as a real function of x and y, leaving it to the compiler to
+# compute Abs from the real and imaginary parts where it can.
+# ParametricPlot3D[{fx, fy, fz}, {u, ...}, {v, ...}] compiles the components as one
+# function returning a list, whose values on the (u, v) grid are the points of the
+# surface. DensityPlot and ContourPlot need no polygons at all: the values on the
+# grid are a Raster, and the contour lines are computed from it by marching squares.
+#
+# Mathics has only DensityPlot, so the others are defined here, as _Plot3D subclasses
+# where they take the same arguments as Plot3D so that they also go through
+# demo_eval_plot3d.
+#
+
+# TODO: ColorFunction, e.g. Arg for ComplexPlot3D
+class ComplexPlot3D(Builtin):
+
+    context = "System`"
+    attributes = mcs.A_HOLD_FIRST | mcs.A_PROTECTED
+    options = mathics.builtin.drawing.plot.Plot3D.options
+
+    def eval(self, functions, z, zstart, zstop, evaluation, options):
+        "ComplexPlot3D[functions_, {z_Symbol, zstart_, zstop_}, OptionsPattern[ComplexPlot3D]]"
+        return demo_eval_complex_plot3d(functions, z, zstart, zstop, evaluation, options)
+
+class ParametricPlot3D(mathics.builtin.drawing.plot._Plot3D):
+
+    context = "System`"
+    attributes = mcs.A_HOLD_FIRST | mcs.A_PROTECTED
+    options = mathics.builtin.drawing.plot.Plot3D.options | {"BoxRatios": "Automatic"}
+
+class ContourPlot(mathics.builtin.drawing.plot._Plot3D):
+
+    context = "System`"
+    attributes = mcs.A_HOLD_FIRST | mcs.A_PROTECTED
+    options = mathics.builtin.drawing.plot.DensityPlot.options | {"Contours": "Automatic"}
+
+@util.Timer("demo_eval_complex_plot3d")
+def demo_eval_complex_plot3d(functions, z, zstart, zstop, evaluation, options):
+
+    # z = x + I y, where x and y get names that can't clash with anything in functions
+    z_name = compile.strip_context(z)
+    x_name, y_name = z_name + "_re", z_name + "_im"
+    z_value = mcs.Expression(mcs.SymbolPlus, mcs.Symbol("Global`" + x_name),
+                             mcs.Expression(mcs.SymbolTimes, mcs.SymbolI, mcs.Symbol("Global`" + y_name)))
+    functions = functions.replace_vars({str(z): z_value})
+    if functions.has_form("List", None):
+        functions = mcs.ListExpression(*(mcs.Expression(mcs.SymbolAbs, f) for f in functions.elements))
+    else:
+        functions = mcs.Expression(mcs.SymbolAbs, functions)
+    try:
+        with util.Timer("compile"):
+            fun = compile.demo_compile(evaluation, functions, [x_name, y_name], real=True)
+        zstart, zstop = (complex(numeric_value(b, evaluation)) for b in (zstart, zstop))
+    except Exception as e:
+        # Mathics has no ComplexPlot3D, so it is left unevaluated
+        print(f"not evaluating System`ComplexPlot3D: {e}")
+        return None
+    return surface_plot3d(fun, x_name, zstart.real, zstop.real, y_name, zstart.imag, zstop.imag, options)
+
+# the components of the surfaces of ParametricPlot3D[{fx, fy, fz}, ...] or
+# ParametricPlot3D[{{fx, fy, fz}, {gx, gy, gz}, ...}, ...] as one flat List,
+# or None if functions isn't either of those
+def parametric_components(functions):
+    if not functions.has_form("List", None) or not functions.elements:
+        return None
+    surfaces = functions.elements if all(f.has_form("List", None) for f in functions.elements) else [functions]
+    if not all(f.has_form("List", 3) for f in surfaces):
+        return None
+    return mcs.ListExpression(*(c for f in surfaces for c in f.elements))
+
+# compute a Graphics3D for a ParametricPlot3D; fun computes the components of each
+# surface in turn, and the other arguments are as for plot3d
+def parametric_plot3d(fun, params, u_name, ustart, ustop, v_name, vstart, vstop, options, grid_cache=None):
+    nu, nv = grid_points(options)
+    us, vs, values = eval_grid(fun, params, u_name, ustart, ustop, nu, v_name, vstart, vstop, nv, grid_cache)
+    xyzs = values.reshape(-1, 3, us.size).transpose(0, 2, 1)                                    # shape = (surfaces, nu*nv, 3)
+    return graphics3d(xyzs, [grid_quads(us.shape)], options)
+
+# number of contours for Contours -> Automatic
+default_contours = 10
+
+# the levels of the contours given by the Contours option, for values from zmin to zmax
+def contour_levels(option, zmin, zmax):
+    value = option.to_python()
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if isinstance(v, (int, float))]
+    n = value if isinstance(value, int) else default_contours
+    return np.linspace(zmin, zmax, n + 2)[1:-1]
+
+# The contour at level through values of shape (ny, nx) on the grid xs, ys, as an array
+# of line segments of shape (n, 2, 2). Marching squares, for all of the cells at once:
+# the contour crosses the edges of a cell whose ends are on opposite sides of level,
+# at a point we find by linear interpolation. A cell has two such crossings, which
+# we join, or four, which we pair up according to which side the center is on.
+def contour_segments(xs, ys, values, level):
+
+    # corners of each cell, counterclockwise from the lower left, and
+    # edges, starting with the bottom one, as pairs of corners
+    lo, hi = slice(None, -1), slice(1, None)
+    corners = [(lo, lo), (lo, hi), (hi, hi), (hi, lo)]
+    vs = [(values[c] - level).reshape(-1) for c in corners]
+    ps = [np.stack([xs[c].reshape(-1), ys[c].reshape(-1)], axis=-1) for c in corners]
+
+    crossings = []
+    points = []
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for a, b in ((0, 1), (1, 2), (2, 3), (3, 0)):
+            crossings.append(((vs[a] > 0) != (vs[b] > 0)) & np.isfinite(vs[a]) & np.isfinite(vs[b]))
+            t = vs[a] / (vs[a] - vs[b])
+            points.append(ps[a] + t[:, None] * (ps[b] - ps[a]))
+    crossings = np.stack(crossings, axis=1)                                                     # shape = (cells, 4)
+    points = np.stack(points, axis=1)                                                           # shape = (cells, 4, 2)
+    count = crossings.sum(axis=1)
+
+    two = count == 2
+    segments = [points[two][crossings[two]].reshape(-1, 2, 2)]
+
+    # saddles: if the center is on the same side as the lower left and upper right
+    # corners the contour cuts off the other two, from the bottom edge to the right one
+    # and from the top edge to the left one; otherwise it cuts off these two
+    four = count == 4
+    if four.any():
+        center = sum(v[four] for v in vs) / 4
+        same = (center > 0) == (vs[0][four] > 0)
+        pairs = np.where(same[:, None], [0, 1, 2, 3], [3, 0, 1, 2])
+        segments.append(np.take_along_axis(points[four], pairs[:, :, None], axis=1).reshape(-1, 2, 2))
+
+    return np.concatenate(segments)
+
+# compute a Graphics for a DensityPlot or ContourPlot, as named by name, of the
+# compiled function fun; the other arguments are as for plot3d
+def density_plot(name, fun, params, x_name, xstart, xstop, y_name, ystart, ystop, options, grid_cache=None):
+
+    nx, ny = grid_points(options)
+    xs, ys, values = eval_grid(fun, params, x_name, xstart, xstop, nx, y_name, ystart, ystop, ny, grid_cache)
+    values = values[0]
+    finite = values[np.isfinite(values)]
+    zmin, zmax = (float(finite.min()), float(finite.max())) if len(finite) else (0.0, 1.0)
+
+    # the grid points are at the centers of the cells of the Raster, whose rows go up in y
+    dx, dy = (xstop - xstart) / max(1, nx - 1) / 2, (ystop - ystart) / max(1, ny - 1) / 2
+    bounds = mcs.from_python([[xstart - dx, ystart - dy], [xstop + dx, ystop + dy]])
+    graphics = [mcs.Expression(mcs.SymbolRaster, mcs.NumpyArrayListExpression(values), bounds, mcs.from_python([zmin, zmax]))]
+
+    if name == "System`ContourPlot":
+        with util.Timer("contours"):
+            for level in contour_levels(options["System`Contours"], zmin, zmax):
+                segments = contour_segments(xs, ys, values, level)
+                if len(segments):
+                    graphics.append(mcs.Expression(mcs.SymbolLine, mcs.NumpyArrayListExpression(segments)))
+
+    options = dict(options)
+    options["System`PlotRange"] = mcs.from_python([[xstart, xstop], [ystart, ystop]])
+    rules = [mcs.Expression(mcs.SymbolRule, mcs.Symbol(n), v) for n, v in options.items()]
+    return mcs.Expression(mcs.SymbolGraphics, mcs.ListExpression(*graphics), *rules)
+
+#
+# Manipulate fast path for Plot3D, and for the 2-D plots below
+#
+# Going through demo_eval_plot3d on every slider move means substituting the slider
+# values into the Manipulate target, evaluating the whole Plot3D through Mathics,
+# and compiling the function with the slider values baked in as literals.
+# Instead we compile the function once with the slider names as additional
+# arguments next to x and y, and on each slider move just call the compiled function
+# with the new slider values. The plot ranges may also depend on the sliders
+# (e.g. {x, 0, xmax}), so those are compiled the same way. Parts of the function
+# that depend only on the grid are computed once per grid and cached for the panel.
+#
+# Returns a function that takes a dict of slider values and returns a Graphics3D
+# (or a Graphics for the 2-D plots), or None if expr is not something we know how
+# to handle this way, in which case the caller should fall back to evaluating expr.
+#
+
+def symbol_names(expr):
+    if not hasattr(expr, "elements"):
+        return {compile.strip_context(expr)} if isinstance(expr, mcs.Symbol) else set()
+    return symbol_names(expr.head).union(*(symbol_names(e) for e in expr.elements))
+
+# {x, xstart, xstop}, or None
+def parse_spec(spec):
+    if getattr(spec, "head", None) != mcs.SymbolList or len(spec.elements) != 3:
+        return None
+    if not isinstance(spec.elements[0], mcs.Symbol):
+        return None
+    return spec.elements
+
+# start with the default options for the plot named name and override with those
+# that were supplied as rules. Options that depend on the sliders would require
+# evaluating on every slider move, so for those we return None to leave them
+# to the slow path
+def manipulate_options(evaluation, name, rules, param_names):
+    options = dict(evaluation.definitions.get_options(name))
+    for rule in rules:
+        if getattr(rule, "head", None) != mcs.SymbolRule or not isinstance(rule.elements[0], mcs.Symbol):
+            return None
+        if symbol_names(rule.elements[1]) & set(param_names):
+            return None
+        options[str(rule.elements[0])] = rule.elements[1]
+    return {n: v.evaluate(evaluation) for n, v in options.items()}
+
+# the Manipulate fast path for whichever kind of plot expr is, or None
+def demo_manipulate_plot(evaluation, expr, param_names):
+    if os.getenv("DEMO_USE_MATHICS_PLOT"):
+        return None
+    head = getattr(expr, "head", None)
+    if head == mcs.SymbolPlot3D:
+        return demo_manipulate_plot3d(evaluation, expr, param_names)
+    if str(head) in curve_coordinates:
+        return demo_manipulate_plot2d(evaluation, expr, param_names)
+    return None
+
+def demo_manipulate_plot3d(evaluation, expr, param_names):
+
+    if len(expr.elements) < 3:
+        return None
+    functions, x_spec, y_spec, *rules = expr.elements
+
+    # {x, xstart, xstop} and {y, ystart, ystop}
+    if not (x_spec := parse_spec(x_spec)) or not (y_spec := parse_spec(y_spec)):
+        return None
+    x, xstart, xstop = x_spec
+    y, ystart, ystop = y_spec
+    x_name, y_name = compile.strip_context(x), compile.strip_context(y)
+    param_names = [n for n in param_names if n not in (x_name, y_name)]
+
+    options = manipulate_options(evaluation, "System`Plot3D", rules, param_names)
+    if options is None:
+        return None
+
+    # compile the function and the plot ranges
+    try:
+        with util.Timer("compile"):
+            grid_names = [x_name, y_name]
+            fun = compile.demo_compile(evaluation, functions, [*grid_names, *param_names], grid_names=grid_names, real=True)
+            bounds = [compile.demo_compile(evaluation, b, param_names, real=True) for b in (xstart, xstop, ystart, ystop)]
+    except Exception as e:
+        print(f"not using Manipulate fast path: {e}")
+        return None
+
+    grid_cache = {}
+
+    @util.Timer("demo_manipulate_plot3d")
+    def eval_plot3d(values):
+        params = {n: values[n] for n in param_names}
+        # np.real because e.g. a negative number to a fractional power is complex in Python
+        # even where type inference says it is real
+        xstart, xstop, ystart, ystop = (float(np.real(b(**params))) for b in bounds)
+        return plot3d(fun, params, x_name, xstart, xstop, y_name, ystart, ystop, options, grid_cache)
+
+    return eval_plot3d
+
+#
+# Plot, LogPlot, PolarPlot and ParametricPlot
+#
+# The Mathics eval_Plot evaluates the function through Mathics, or the Mathics compiler,
+# one point at a time, and builds the lines as Python lists of Mathics Reals.
+# demo_eval_Plot instead compiles each function with demo_compile and evaluates it
+# on all of the parameter values in one call, splits the resulting curve into
+# lines where it is not real or finite, and emits each line as a
+# NumpyArrayListExpression of shape (n, 2) that collect_graphics passes straight
+# through to the layout. Anything we don't handle, e.g. a ParametricPlot of something
+# that isn't a list of two functions, goes to the Mathics eval_Plot.
+#
+
+# as in Mathics
+default_plot_points = 57
+default_max_recursion = 3
+max_recursion_limit = 15
+
+# upper bound on the number of points on each curve, for adaptive sampling
+max_plot_points = int(os.getenv("DEMO_PLOT_MAX_POINTS", "20000"))
+
+# imaginary parts smaller than this are rounding error, not a complex value
+complex_tolerance = 1e-10
+
+# for each kind of plot we handle, how to compute the coordinates of the points
+# on a curve from the parameter values ts and the values of its component functions
+curve_coordinates = {
+    "System`Plot": lambda ts, y: (ts, y),
+    "System`LogPlot": lambda ts, y: (ts, np.log10(y)),
+    "System`PolarPlot": lambda ts, r: (r * np.cos(ts), r * np.sin(ts)),
+    "System`ParametricPlot": lambda ts, x, y: (x, y),
+}
+
+# the component functions of each curve, or None if we don't know how to plot them
+def curve_components(name, functions):
+    if name != "System`ParametricPlot":
+        return [[f] for f in functions]
+    if all(f.has_form("List", 2) for f in functions):
+        return [list(f.elements) for f in functions]
+    # Mathics flattens {{fx, fy}, {gx, gy}} into fx, fy, gx, gy
+    if len(functions) % 2 == 0 and not any(f.has_form("List", None) for f in functions):
+        return [functions[i:i+2] for i in range(0, len(functions), 2)]
+    return None
+
+# the values of a compiled component function at ts, with nan where it isn't real,
+# as Mathics leaves out points where the function isn't a real number
+def eval_component(fun, t_name, ts, params):
+    values = fun(**{t_name: ts}, **params)
+    values = np.broadcast_to(values, ts.shape)
+    if np.iscomplexobj(values):
+        values = np.where(abs(values.imag) > complex_tolerance, np.nan, values.real)
+    return values.astype(float)
+
+# points of shape (n, 2) on the curve given by the component functions funs at ts
+def eval_curve(coordinates, funs, t_name, ts, params):
+    with np.errstate(all="ignore"):
+        xs, ys = coordinates(ts, *(eval_component(f, t_name, ts, params) for f in funs))
+    return np.stack(np.broadcast_arrays(xs, ys), axis=-1)
+
+# split the points of a curve into lines at points that aren't finite,
+# and at the numeric exclusions, which are parameter values
+def split_lines(ts, points, exclusions):
+    finite = np.isfinite(points).all(axis=1)
+    if exclusions == "System`None":
+        # Mathics joins everything into one line
+        return [points[finite]]
+    breaks = ~finite[:-1] | ~finite[1:]
+    for excl in exclusions:
+        if isinstance(excl, (int, float)):
+            breaks |= (ts[:-1] < excl) & (excl < ts[1:])
+    runs = np.split(np.arange(len(ts)), np.flatnonzero(breaks) + 1)
+    return [points[run] for run in runs if finite[run[0]]]
+
+#
+# Adaptive sampling. Like the Mathics eval_Plot we start with plot_points evenly spaced
+# parameter values and then, up to max_recursion times, subdivide the segments on either
+# side of each point where the curve bends by more than a degree, measured after
+# scaling both axes to the range of the base points. But instead of testing and
+# subdividing one point at a time, each round tests every point of the curve at once,
+# and evaluates the midpoints of all of the segments to be subdivided in one call.
+# We also subdivide segments that go from a point on the curve to one where the
+# curve isn't real or finite, so that lines end close to where the curve does.
+# The number of points is bounded by max_plot_points: if a round would exceed
+# that we subdivide just the segments next to the sharpest bends.
+#
+
+# cosine of the largest angle between successive segments that doesn't need subdividing
+bend_threshold = math.cos(math.pi / 180)
+
+# which segments between successive points to subdivide, and a score for each
+# that is lower for the ones that need it more
+def segments_to_split(points, xscale, yscale):
+    finite = np.isfinite(points).all(axis=1)
+    vs = np.diff(points, axis=0) * (xscale, yscale)
+    v1, v2 = vs[:-1], vs[1:]
+    with np.errstate(all="ignore"):
+        # nan where a segment has zero length or isn't finite; those aren't bends
+        # Mathics compares the absolute value of the cosine, which misses hairpin
+        # turns, like those of a fast oscillation sampled too coarsely
+        bend = (v1 * v2).sum(axis=1) / np.sqrt((v1 * v1).sum(axis=1) * (v2 * v2).sum(axis=1))
+    bent = bend < bend_threshold
+    split = np.zeros(len(vs), bool)
+    split[:-1] |= bent
+    split[1:] |= bent
+    score = np.full(len(vs), np.inf)
+    score[:-1] = np.fmin(score[:-1], np.where(bent, bend, np.inf))
+    score[1:] = np.fmin(score[1:], np.where(bent, bend, np.inf))
+    edges = finite[:-1] != finite[1:]
+    split |= edges
+    score[edges] = 0
+    return split, score
+
+# Sample a curve adaptively. Returns the parameter values ts, the points of shape
+# (len(ts), 2), and which of the points are base points
+def sample_curve(coordinates, funs, t_name, params, tstart, tstop, plot_points, max_recursion):
+
+    ts = np.linspace(tstart, tstop, plot_points)
+    points = eval_curve(coordinates, funs, t_name, ts, params)
+    base = np.ones(len(ts), bool)
+
+    # as in Mathics, bends are measured relative to the range of the base points
+    finite = points[np.isfinite(points).all(axis=1)]
+    xmin, xmax = automatic_plot_range(finite[:, 0])
+    ymin, ymax = automatic_plot_range(finite[:, 1])
+    xscale, yscale = 1 / ((xmax - xmin) or 1), 1 / ((ymax - ymin) or 1)
+
+    for _ in range(max_recursion):
+        split, score = segments_to_split(points, xscale, yscale)
+        segments = np.flatnonzero(split)
+        budget = max_plot_points - len(ts)
+        if len(segments) > budget:
+            segments = np.sort(segments[np.argsort(score[segments], kind="stable")[:budget]])
+        if not len(segments):
+            break
+        mids = (ts[segments] + ts[segments + 1]) / 2
+        ts = np.insert(ts, segments + 1, mids)
+        points = np.insert(points, segments + 1, eval_curve(coordinates, funs, t_name, mids, params), axis=0)
+        base = np.insert(base, segments + 1, False)
+
+    return ts, points, base
+
+# vectorized versions of automatic_plot_range and get_plot_range
+# from mathics.eval.drawing.plot
+def automatic_plot_range(values):
+    if not len(values):
+        return 0, 1
+    # throw away values more than two standard deviations from the mean
+    dev = values.std(ddof=1) if len(values) > 1 else 0
+    if dev != 0:
+        values = values[abs(values - values.mean()) / dev < 2.0]
+    vmin, vmax = values.min(), values.max()
+    vrange = vmax - vmin
+    return float(vmin - 0.05 * vrange), float(vmax + 0.05 * vrange)
+
+def get_plot_range(values, all_values, option):
+    if option == "System`Automatic":
+        lo, hi = automatic_plot_range(values)
+    elif option == "System`All":
+        lo, hi = (float(all_values.min()), float(all_values.max())) if len(all_values) else (0, 1)
+    else:
+        lo, hi = option
+    if lo == hi:
+        return (0, lo * 2) if lo > 0 else (lo * 2, 0) if lo < 0 else (-1, 1)
+    return lo, hi
+
+# compute a Graphics for the curves given by lists of compiled component functions,
+# for the plot named name; params supplies values for any arguments of the functions
+# other than t_name
+def plot2d(name, curves, params, t_name, tstart, tstop, x_range, y_range,
+           plot_points, max_recursion, mesh, exclusions, options):
+
+    coordinates = curve_coordinates[name]
+    hue, hue_pos, hue_neg = 0.67, 0.236068, -0.763932
+    graphics = []
+    mesh_points = []
+    base_points = []
+    all_points = []
+    with util.Timer("compute lines"):
+        for i, funs in enumerate(curves):
+            ts, points, base = sample_curve(coordinates, funs, t_name, params, tstart, tstop, plot_points, max_recursion)
+            lines = split_lines(ts, points, exclusions)
+            base_points.append(points[base])
+            graphics.append(mcs.Expression(mcs.SymbolHue, mcs.Real(hue), mcs.Real(0.6), mcs.Real(0.6)))
+            if len(lines) == 1:
+                graphics.append(mcs.Expression(mcs.SymbolLine, mcs.NumpyArrayListExpression(lines[0])))
+            else:
+                lines_expr = mcs.ListExpression(*(mcs.NumpyArrayListExpression(line) for line in lines))
+                graphics.append(mcs.Expression(mcs.SymbolLine, lines_expr))
+            all_points.extend(lines)
+            if mesh == "System`Full":
+                mesh_points.append((hue, points[base][np.isfinite(points[base]).all(axis=1)]))
+            elif mesh == "System`All":
+                mesh_points.append((hue, np.concatenate(lines) if lines else np.empty((0, 2))))
+            # same sequence of hues as Mathics
+            hue += hue_pos if i % 4 == 0 else hue_neg
+            hue = hue - 1 if hue > 1 else hue + 1 if hue < 0 else hue
+
+    for hue, points in mesh_points:
+        graphics.append(mcs.Expression(mcs.SymbolHue, mcs.Real(hue), mcs.Real(0.6), mcs.Real(0.6)))
+        graphics.append(mcs.Expression(mcs.SymbolPoint, mcs.NumpyArrayListExpression(points)))
+
+    # plot range, from the base points if Automatic and all the points if All,
+    # moved to include 0 for positive plots as Mathics does
+    def finite_points(points):
+        points = np.concatenate(points) if points else np.empty((0, 2))
+        return points[np.isfinite(points).all(axis=1)]
+    base_points, all_points = finite_points(base_points), finite_points(all_points)
+    x_range = get_plot_range(base_points[:, 0], all_points[:, 0], x_range)
+    y_range = get_plot_range(base_points[:, 1], all_points[:, 1], y_range)
+    if x_range[0] > 0:
+        x_range = (-0.1, x_range[1])
+    if y_range[0] > 0:
+        y_range = (-0.1, y_range[1])
+    options = dict(options)
+    options["System`PlotRange"] = mcs.from_python([x_range, y_range])
+    if name == "System`LogPlot":
+        options["System`LogPlot"] = mcs.SymbolTrue
+
+    rules = [mcs.Expression(mcs.SymbolRule, mcs.Symbol(n), v) for n, v in options.items()]
+    return mcs.Expression(mcs.SymbolGraphics, mcs.ListExpression(*graphics), *rules)
+
+# compile the component functions of each curve, with the parameters as additional arguments
+def compile_curves(evaluation, curves, t_name, param_names):
+    with util.Timer("compile"):
+        return [
+            [compile.demo_compile(evaluation, f, [t_name, *param_names]) for f in components]
+            for components in curves
+        ]
+
+# replaces mathics.eval.drawing.plot.eval_Plot, which is called for Plot, LogPlot,
+# PolarPlot and ParametricPlot with the same arguments, so we find out which one
+# from the instance that apply_fn is bound to
+@util.Timer("demo_eval_Plot")
+def demo_eval_Plot(
+    functions, apply_fn, x_name, start, stop, x_range, y_range, plot_points,
+    mesh, list_is_expected, exclusions, max_recursion, use_log_scale,
+    options, evaluation,
+):
+    name = apply_fn.__self__.get_name() if hasattr(apply_fn, "__self__") else None
+    curves = curve_components(name, functions) if name in curve_coordinates else None
+    if curves is not None and mesh in ("System`None", "System`Full", "System`All"):
+        t_name = compile.strip_context(x_name)
+        try:
+            curves = compile_curves(evaluation, curves, t_name, [])
+        except Exception as e:
+            print(f"using Mathics {name}: {e}")
+        else:
+            return plot2d(name, curves, {}, t_name, start, stop, x_range, y_range,
+                          plot_points, max_recursion, mesh, exclusions, options)
+    return mathics_eval_Plot(
+        functions, apply_fn, x_name, start, stop, x_range, y_range, plot_points,
+        mesh, list_is_expected, exclusions, max_recursion, use_log_scale,
+        options, evaluation,
+    )
+
+# PlotPoints, MaxRecursion, Mesh and Exclusions from options, in the form
+# that eval_Plot gets them, or None if they aren't the simple cases we handle
+def plot2d_settings(options):
+    plot_points = options["System`PlotPoints"].to_python()
+    if plot_points == "System`None":
+        plot_points = default_plot_points
+    max_recursion = options["System`MaxRecursion"].to_python()
+    if max_recursion == "System`Automatic":
+        max_recursion = default_max_recursion
+    mesh = options["System`Mesh"].to_python()
+    exclusions = options["System`Exclusions"].to_python()
+    if exclusions in ("System`None", ["System`None"]):
+        exclusions = "System`None"
+    elif not isinstance(exclusions, list):
+        exclusions = [exclusions]
+    if not (isinstance(plot_points, int) and plot_points >= 2):
+        return None
+    if not (isinstance(max_recursion, int) and 0 <= max_recursion <= max_recursion_limit):
+        return None
+    if mesh not in ("System`None", "System`Full", "System`All"):
+        return None
+    return plot_points, max_recursion, mesh, exclusions
+
+# Manipulate fast path for the 2-D plots - see demo_manipulate_plot3d
+def demo_manipulate_plot2d(evaluation, expr, param_names):
+
+    if len(expr.elements) < 2:
+        return None
+    name = str(expr.head)
+    functions, t_spec, *rules = expr.elements
+    if not (t_spec := parse_spec(t_spec)):
+        return None
+    t, tstart, tstop = t_spec
+    t_name = compile.strip_context(t)
+    param_names = [n for n in param_names if n != t_name]
+
+    # the list of functions, as Mathics passes it to eval_Plot
+    if functions.has_form("List", None):
+        if name == "System`ParametricPlot" and functions.has_form("List", 2) \
+                and not any(f.has_form("List", None) for f in functions.elements):
+            functions = [functions]
+        else:
+            functions = list(functions.elements)
+    else:
+        functions = [functions]
+
+    if (curves := curve_components(name, functions)) is None:
+        return None
+    options = manipulate_options(evaluation, name, rules, param_names)
+    if options is None or (settings := plot2d_settings(options)) is None:
+        return None
+    import mathics.eval.drawing.plot
+    x_range, y_range = mathics.eval.drawing.plot.get_plot_range_option(options, evaluation, name)
+
+    try:
+        curves = compile_curves(evaluation, curves, t_name, param_names)
+        with util.Timer("compile"):
+            bounds = [compile.demo_compile(evaluation, b, param_names, real=True) for b in (tstart, tstop)]
+    except Exception as e:
+        print(f"not using Manipulate fast path: {e}")
+        return None
+
+    @util.Timer("demo_manipulate_plot2d")
+    def eval_plot2d(values):
+        params = {n: values[n] for n in param_names}
+        tstart, tstop = (float(np.real(b(**params))) for b in bounds)
+        return plot2d(name, curves, params, t_name, tstart, tstop, x_range, y_range, *settings, options)
+
+    return eval_plot2d
+
 if os.getenv("DEMO_USE_MATHICS_PLOT"):
     print("using mathics plot")
 else:
     # for demo monkey-patch it in
     print("using demo plot")
-    import mathics.builtin.drawing.plot
+    mathics_eval_plot3d = mathics.builtin.drawing.plot.eval_plot3d
     mathics.builtin.drawing.plot.eval_plot3d = demo_eval_plot3d
     mathics.builtin.drawing.plot.Plot3D.attributes = mcs.A_HOLD_FIRST | mcs.A_PROTECTED
+    mathics.builtin.drawing.plot.DensityPlot.attributes = mcs.A_HOLD_FIRST | mcs.A_PROTECTED
+    add_builtins([
+        ("System`ComplexPlot3D", ComplexPlot3D(expression=False)),
+        ("System`ParametricPlot3D", ParametricPlot3D(expression=False)),
+        ("System`ContourPlot", ContourPlot(expression=False)),
+    ])
+    mathics_eval_Plot = mathics.builtin.drawing.plot.eval_Plot
+    mathics.builtin.drawing.plot.eval_Plot = demo_eval_Plot
 
 
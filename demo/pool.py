@@ -0,0 +1,340 @@
+"""
+Buffer pool for compiled functions.
+
+Compiled code evaluates things like x**2 + y**2 with numpy operations that each
+allocate a fresh grid-sized temporary. At high PlotPoints allocating and touching
+that memory becomes the bottleneck, so use_buffer_pool rewrites the ast generated
+by compile.AstCtx so that numpy ufuncs write their results through the out= argument
+into preallocated arrays from a BufferPool that is kept with the compiled function,
+reusing the same few arrays on every call.
+
+Temporaries are planned at compile time: each ufunc in an expression gets a slot,
+reusing the slot of its first argument if that was itself a temporary, so an
+expression needs roughly as many buffers as it is deep rather than one per operation.
+Only intermediate values live in pool buffers. Anything that is stored (assigned
+to a variable, put in a list, passed to a function we don't know about) or returned
+gets a fresh array, or the caller-supplied output array.
+
+Updates like z += rhs in a loop, which compile to z = z + rhs, are done in place
+in z's array when it is safe to do so - see Planner.updatable.
+"""
+
+import ast
+import builtins
+import collections
+import itertools
+import numpy as np
+import operator
+import threading
+
+class BufferPool:
+
+    # maximum number of buffers kept per thread; we start over if we go over this,
+    # e.g. because a Manipulate slider is changing the plot range
+    max_buffers = 64
+
+    def __init__(self):
+        # compiled functions may be run on several threads at once, e.g. for tiles of a grid,
+        # so each thread gets its own buffers
+        self.local = threading.local()
+
+    # the buffer to use for the result of ufunc applied to args in the given slot,
+    # or None if the result is not an array
+    def buffer(self, slot, ufunc, args):
+        shapes = [a.shape for a in args if isinstance(a, np.ndarray)]
+        shape = shapes[0] if all(s == shapes[0] for s in shapes) else np.broadcast_shapes(*shapes)
+        if shape == ():
+            return None
+        key = (slot, shape, ufunc_dtype(ufunc, args))
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None or len(buffers) > self.max_buffers:
+            buffers = self.local.buffers = {}
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = buffers[key] = np.empty(shape, key[2])
+        return buffer
+
+    # compute ufunc(*args) into the buffer for slot
+    def apply(self, ufunc, slot, *args):
+        if not any(isinstance(a, np.ndarray) for a in args):
+            return scalar(ufunc, args)
+        return ufunc(*args, out=self.buffer(slot, ufunc, args))
+
+    # compute ufunc(*args) into out, which may be None
+    def into(self, out, ufunc, *args):
+        if out is None and not any(isinstance(a, np.ndarray) for a in args):
+            return scalar(ufunc, args)
+        return ufunc(*args, out=out)
+
+    # compute ufunc(target, *args) for an update like z += rhs, in place if target
+    # is an array that can hold the result, otherwise into a new array or scalar,
+    # e.g. if target is still the 0 that it was initialized with
+    def update(self, ufunc, target, *args):
+        if isinstance(target, np.ndarray):
+            shapes = [a.shape for a in args if isinstance(a, np.ndarray)]
+            if all(s == target.shape for s in shapes) or np.broadcast_shapes(target.shape, *shapes) == target.shape:
+                if ufunc_dtype(ufunc, (target, *args)) == target.dtype:
+                    return ufunc(target, *args, out=target)
+        return self.into(None, ufunc, target, *args)
+
+# Python operators that binop_ufuncs below replaced, used when no args are arrays so
+# that scalar code like loop counters behaves exactly as before, e.g. 2**-1 is 0.5
+# and not an error, and results are Python numbers and not numpy scalars
+scalar_ops = {
+    np.add: operator.add,
+    np.subtract: operator.sub,
+    np.multiply: operator.mul,
+    np.true_divide: operator.truediv,
+    np.power: operator.pow,
+    np.square: lambda x: x ** 2,
+}
+
+def scalar(ufunc, args):
+    op = scalar_ops.get(ufunc)
+    return op(*args) if op else ufunc(*args)
+
+# the dtype of the result of applying ufunc to args, according to numpy's own rules,
+# found by trying it on one-element arrays, or on args itself for Python scalars
+# since those take part in type promotion differently
+ufunc_dtypes = {}
+def ufunc_dtype(ufunc, args):
+    key = (ufunc, *(getattr(a, "dtype", type(a)) for a in args))
+    dtype = ufunc_dtypes.get(key)
+    if dtype is None:
+        probe = [np.ones(1, a.dtype) if hasattr(a, "dtype") else a for a in args]
+        with np.errstate(all="ignore"):
+            dtype = ufunc_dtypes[key] = ufunc(*probe).dtype
+    return dtype
+
+
+#
+# compile-time planning
+#
+
+binop_ufuncs = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+
+# functions that consume their arguments, i.e. don't hold on to them,
+# so their arguments can live in pool buffers
+consumers = set([np.where])
+
+def dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute) and (base := dotted_name(node.value)):
+        return f"{base}.{node.attr}"
+    return None
+
+# the object that a Name or Attribute node refers to in namespace, or None
+def resolve(node, namespace):
+    name = dotted_name(node)
+    if name is None:
+        return None
+    first = name.split(".")[0]
+    obj = namespace.get(first, getattr(builtins, first, None))
+    for attr in name.split(".")[1:]:
+        obj = getattr(obj, attr, None)
+    return obj
+
+# ast for one of the numpy ufuncs above
+def ufunc_ast(ufunc):
+    return ast.Attribute(ast.Name("np", ast.Load()), ufunc.__name__, ast.Load())
+
+def pool_method(name):
+    return ast.Attribute(ast.Name("__pool", ast.Load()), name, ast.Load())
+
+class Planner:
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.slots = itertools.count()
+        self.temporaries = 0
+
+    # if node is a ufunc application return the ufunc, as an ast expression, and its args
+    def ufunc(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in binop_ufuncs:
+            if isinstance(node.op, ast.Pow) and isinstance(node.right, ast.Constant) and node.right.value == 2:
+                return ufunc_ast(np.square), [node.left]
+            return ufunc_ast(binop_ufuncs[type(node.op)]), [node.left, node.right]
+        elif isinstance(node, ast.Call) and not node.keywords:
+            fun = resolve(node.func, self.namespace)
+            # sum([a, b, c]) and math.prod([a, b, c]) become add(add(a, b), c) etc.
+            if fun in (sum, np.sum, self.namespace.get("math").prod) and len(node.args) == 1:
+                arg = node.args[0]
+                if isinstance(arg, ast.List) and len(arg.elts) >= 2:
+                    op = ast.Add() if fun in (sum, np.sum) else ast.Mult()
+                    folded = arg.elts[0]
+                    for e in arg.elts[1:]:
+                        folded = ast.BinOp(folded, op, e)
+                    return self.ufunc(folded)
+            if isinstance(fun, np.ufunc) and fun.nout == 1 and fun.nin == len(node.args):
+                return node.func, node.args
+        return None
+
+    # Local variables whose updates like z = z + rhs can be done in place.
+    # That is safe if the variable always holds an array that nothing else refers to:
+    # it's not an argument, every other assignment to it is a constant or a new array
+    # computed by a ufunc, and its value is only ever consumed by ufuncs and the like,
+    # not assigned to another variable or passed to an arbitrary function.
+    def updatable(self, fdef):
+
+        # variables in nested functions would need more care
+        if any(isinstance(s, ast.FunctionDef) for s in ast.walk(fdef) if s is not fdef):
+            return set()
+
+        # likewise the lambdas that masked If generates: any variable used in
+        # one might be used when it runs, so is not updated in place
+        in_lambdas = set(
+            n.id for l in ast.walk(fdef) if isinstance(l, ast.Lambda)
+            for n in ast.walk(l.body) if isinstance(n, ast.Name)
+        )
+
+        loaded = set(n.id for n in ast.walk(fdef) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load))
+        kinds = collections.defaultdict(set)
+        escaping = set()
+
+        def walk(node, consumed):
+            if isinstance(node, ast.Name):
+                if not consumed:
+                    escaping.add(node.id)
+            elif op := self.ufunc(node):
+                for a in op[1]:
+                    walk(a, True)
+            elif isinstance(node, ast.Call) and resolve(node.func, self.namespace) in consumers:
+                for a in node.args:
+                    walk(a, True)
+            else:
+                consumed = isinstance(node, (ast.Compare, ast.UnaryOp, ast.BoolOp))
+                for child in ast.iter_child_nodes(node):
+                    walk(child, consumed)
+
+        def stmts(body):
+            for stmt in body:
+                if isinstance(stmt, ast.Assign):
+                    target = stmt.targets[0].id
+                    if op := self.ufunc(stmt.value):
+                        first = op[1][0]
+                        update = isinstance(first, ast.Name) and first.id == target
+                        kinds[target].add("update" if update else "new")
+                    else:
+                        kinds[target].add("new" if isinstance(stmt.value, ast.Constant) else "other")
+                    # assigning to a variable that is never used doesn't matter
+                    if target in loaded:
+                        walk(stmt.value, False)
+                elif isinstance(stmt, (ast.Expr, ast.Return)):
+                    # values that are discarded or returned can't be changed afterwards
+                    walk(stmt.value, True)
+                elif isinstance(stmt, (ast.While, ast.If)):
+                    walk(stmt.test, True)
+                    stmts(stmt.body)
+                    stmts(stmt.orelse)
+
+        stmts(fdef.body)
+        args = set(a.arg for a in fdef.args.args)
+        return set(
+            n for n, k in kinds.items()
+            if "update" in k and k <= {"update", "new"} and n not in args and n not in escaping and n not in in_lambdas
+        )
+
+    # rewrite a function, and all functions nested in it
+    # tail is the set of names of functions whose return value is the
+    # return value of the top-level function, and so may be written to __out
+    def function(self, fdef, tail):
+        ids = [] # slots used by this function
+        self.updates = self.updatable(fdef)
+        for stmt in fdef.body:
+            self.stmt(stmt, ids, fdef.name in tail and stmt is fdef.body[-1])
+
+    def stmt(self, stmt, ids, is_tail):
+        if isinstance(stmt, ast.FunctionDef):
+            pass # handled separately
+        elif isinstance(stmt, (ast.While, ast.If)):
+            stmt.test = self.root(stmt.test, ids)
+            for s in [*stmt.body, *stmt.orelse]:
+                self.stmt(s, ids, False)
+        elif isinstance(stmt, ast.Assign) and stmt.targets[0].id in self.updates:
+            stmt.value = self.root(stmt.value, ids, update=stmt.targets[0].id)
+        elif isinstance(stmt, (ast.Expr, ast.Assign)):
+            stmt.value = self.root(stmt.value, ids)
+        elif isinstance(stmt, ast.Return):
+            stmt.value = self.root(stmt.value, ids, is_tail)
+
+    # rewrite the expression tree rooted at node, whose value is not a temporary
+    # slots in a function are all free again at the start of each root,
+    # but are not shared with other functions, since a value may be held in a
+    # slot across a call to a nested function
+    # if update is given node is being assigned to that variable, which is in self.updates
+    def root(self, node, ids, is_tail=False, update=None):
+
+        free = list(ids)
+        def allocate():
+            if not free:
+                ids.append(next(self.slots))
+                free.append(ids[-1])
+            return free.pop()
+
+        # returns the rewritten node, and the slot its value is in, if any
+        # may_pool says whether the consumer of the value allows it to be in a pool buffer
+        def rewrite(node, may_pool):
+            if op := self.ufunc(node):
+                fun, args = op
+                args = [rewrite(a, True) for a in args]
+                slots = [s for _, s in args if s is not None]
+                free.extend(slots[1:])
+                if may_pool:
+                    slot = slots[0] if slots else allocate()
+                    self.temporaries += not slots
+                    node = ast.Call(pool_method("apply"), [fun, ast.Constant(slot), *(a for a, _ in args)], [])
+                    return node, slot
+                free.extend(slots[:1])
+                first = args[0][0]
+                if update and node is root_node and isinstance(first, ast.Name) and first.id == update:
+                    node = ast.Call(pool_method("update"), [fun, *(a for a, _ in args)], [])
+                    return node, None
+                out = ast.Name("__out", ast.Load()) if is_tail and node is root_node else ast.Constant(None)
+                node = ast.Call(pool_method("into"), [out, fun, *(a for a, _ in args)], [])
+                return node, None
+            elif isinstance(node, ast.Call) and resolve(node.func, self.namespace) in consumers:
+                args = [rewrite(a, True) for a in node.args]
+                free.extend(s for _, s in args if s is not None)
+                node.args = [a for a, _ in args]
+                return node, None
+            else:
+                for field, value in ast.iter_fields(node):
+                    if isinstance(value, ast.expr):
+                        setattr(node, field, rewrite(value, False)[0])
+                    elif isinstance(value, list):
+                        setattr(node, field, [rewrite(v, False)[0] if isinstance(v, ast.expr) else v for v in value])
+                return node, None
+
+        root_node = node
+        return rewrite(node, False)[0]
+
+# Rewrite module, which contains one top-level function as generated by AstCtx,
+# to use a buffer pool. The top-level function must take __pool and __out arguments.
+# namespace is where the generated code will be run, used to identify ufuncs.
+# Returns the number of temporaries planned.
+def use_buffer_pool(module, namespace):
+
+    top = module.body[0]
+    functions = {f.name: f for f in ast.walk(top) if isinstance(f, ast.FunctionDef)}
+
+    # follow tail calls from the top-level function
+    tail = set()
+    f = top
+    while f is not None:
+        tail.add(f.name)
+        last = f.body[-1]
+        f = None
+        if isinstance(last, ast.Return) and isinstance(last.value, ast.Call) and isinstance(last.value.func, ast.Name):
+            f = functions.get(last.value.func.id)
+
+    planner = Planner(namespace)
+    for f in functions.values():
+        planner.function(f, tail)
+    return planner.temporaries
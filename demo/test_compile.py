@@ -0,0 +1,126 @@
+import ast
+import os
+
+import numpy as np
+import pytest
+
+import codecache
+import compile
+import mcs
+import pool
+
+session = mcs.MathicsSession()
+
+def compile_src(src, arg_names, **options):
+    return compile.demo_compile(session.evaluation, session.parse(src), arg_names, **options)
+
+xs, ys = np.meshgrid(np.linspace(-2, 2, 30), np.linspace(1, 2, 20))
+
+# a variable used in a lambda of a masked If isn't updated in place afterwards
+def test_updatable_lambda():
+    module = ast.parse(
+        "def f(__, __pool, __out, x):\n"
+        "    z = np.multiply(2, x)\n"
+        "    w = masked_if(x > 0, lambda: np.sin(z), lambda: np.cos(z))\n"
+        "    z = np.add(z, 1)\n"
+        "    return w\n"
+    )
+    assert pool.Planner(vars(compile)).updatable(module.body[0]) == set()
+
+def test_if_branch_then_update():
+    fun = compile_src("Module[{z = 2 x, w}, w = If[y > 0, z, Sin[z]]; z += 1; w]", ["x", "y"], masked=True)
+    assert np.allclose(fun(x=xs, y=ys), 2 * xs)
+
+# functions evaluated through Mathics see the current definitions
+def test_pointwise_redefinition():
+    session.evaluate("f[t_] := t + 1")
+    assert np.allclose(compile_src("f[x y]", ["x", "y"])(x=xs, y=ys), xs * ys + 1)
+    session.evaluate("f[t_] := t + 2")
+    assert np.allclose(compile_src("f[x y]", ["x", "y"])(x=xs, y=ys), xs * ys + 2)
+
+# masked_if is a pool consumer, so its result mustn't be one of its variables
+def test_masked_if_copies():
+    for cond in (True, np.ones(xs.shape, bool)):
+        x = xs.copy()
+        result = compile.masked_if(cond, lambda x: x, lambda x: np.sin(x), x)
+        result += 1
+        assert np.array_equal(x, xs)
+
+# the fractal in plots.m is compiled by numba rather than falling back to numpy
+def test_fractal_numba():
+    pytest.importorskip("numba")
+    src = open(os.path.join(os.path.dirname(__file__), "demos", "plots.m")).read()
+    start = src.index("Module[")
+    depth = 0
+    for end in range(start, len(src)):
+        depth += {"[": 1, "]": -1}.get(src[end], 0)
+        if depth == 0 and src[end] == "]":
+            break
+    expr = session.parse(src[start:end+1])
+    arg_names = ["x", "y", "n", "fmul", "adiv"]
+    fun = compile.demo_compile(session.evaluation, expr, arg_names, lib="numba")
+    result = fun(x=xs, y=ys, n=6, fmul=2, adiv=2)
+    assert fun.lib == "numba" and not fun.fun.failed
+    expected = compile.demo_compile(session.evaluation, expr, arg_names)(x=xs, y=ys, n=6, fmul=2, adiv=2)
+    assert np.allclose(result, expected)
+
+# a power of an expression with side effects evaluates it once
+def test_power_of_statement():
+    fun = compile_src("Module[{c = 0}, (c += x)^3; c]", ["x", "y"])
+    assert np.allclose(fun(x=xs, y=ys), xs)
+
+# a variable that the compiled code couldn't find is an error when compiling, not calling
+def test_free_variable():
+    with pytest.raises(compile.ResolveError):
+        compile_src("Sin[k x]", ["x", "y"])
+
+# comparisons we don't compile aren't evaluated through Mathics, as they aren't numbers
+def test_comparison_not_pointwise():
+    assert np.array_equal(compile_src("If[x > 0, 1, 2]", ["x", "y"])(x=xs, y=ys), np.where(xs > 0, 1, 2))
+    with pytest.raises(Exception, match="Unknown head"):
+        compile_src("If[x < 0, 1, 2]", ["x", "y"])
+
+# sweeps of a List give a sweep of each element, whether or not they can be broadcast
+def test_sweep_list():
+    a = np.linspace(1, 2, 5)
+    for src in ["{Sin[a x], y}", "Module[{z = 0, i}, For[i = 1, i <= a, i++, z += x]; {z, y}]"]:
+        fun = compile_src(src, ["x", "y", "a"], grid_names=["x", "y"])
+        swept = fun.sweep(["a"], x=xs, y=ys, a=a)
+        for i, v in enumerate(a):
+            for s, expected in zip(swept, fun(x=xs, y=ys, a=v)):
+                assert np.allclose(s[i], expected)
+
+# only a failure to broadcast makes a sweep go one value at a time; anything else is raised
+def test_sweep_errors():
+    class Fun:
+        def invariants(self, **kwargs):
+            return {}
+        def __call__(self, invariants, out, **kwargs):
+            raise TypeError("a bug")
+    with pytest.raises(TypeError):
+        compile.sweep(Fun(), ["a"], None, dict(x=xs, a=np.ones(3)))
+
+# compiled code round-trips through the disk cache, which a change of compiler version
+# or of options misses
+def test_disk_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(compile, "disk_cache", codecache.DiskCache(str(tmp_path), 1 << 20))
+    def compiled(**options):
+        compile.cache.clear()
+        fun = compile_src("Sin[x] + y^2", ["x", "y"], **options)
+        assert np.allclose(fun(x=xs, y=ys), np.sin(xs) + ys**2)
+        return fun.report.cache
+    assert compiled() == "compiled"
+    assert compiled() == "disk"
+    assert compiled(inplace=False) == "compiled"
+    monkeypatch.setattr(compile, "COMPILER_VERSION", compile.COMPILER_VERSION + 1)
+    assert compiled() == "compiled"
+    assert compile.disk_cache.stats()["hits"] == 1
+    assert not [p for p in tmp_path.iterdir() if p.suffix == ".tmp"]
+
+# the least recently used entries are evicted to stay within the size limit
+def test_disk_cache_eviction(tmp_path):
+    cache = codecache.DiskCache(str(tmp_path), 250)
+    for i in range(3):
+        cache.put(i, b"x" * 100)
+        os.utime(cache.path(i), (i, i))
+    assert cache.get(0) is None and cache.get(1) == b"x" * 100 and cache.get(2) == b"x" * 100
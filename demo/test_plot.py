@@ -0,0 +1,170 @@
+import mathics.builtin.drawing.plot
+import numpy as np
+
+import compile
+import graphics
+import mcs
+import plot
+
+session = mcs.MathicsSession()
+
+# the lines that a 2-D plot draws, as arrays of points
+def plot_lines(src):
+    _, _, lines, _, _ = graphics.collect_graphics(session.evaluate(src))
+    return [np.asarray(line) for line in lines]
+
+# the lines that the Mathics Plot draws, for comparison
+def mathics_plot_lines(src, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(mathics.builtin.drawing.plot, "eval_Plot", plot.mathics_eval_Plot)
+        return plot_lines(src)
+
+# a comparison isn't evaluated through Mathics as nan, which If would take as true;
+# Plot falls back to Mathics instead
+def test_comparison_under_if():
+    [line] = plot_lines("Plot[If[x < 0, 1, 2], {x, -1, 1}, PlotPoints -> 5, MaxRecursion -> 0]")
+    assert np.array_equal(line, [[-1, 1], [-0.5, 1], [0, 2], [0.5, 2], [1, 2]])
+
+# with lib="auto", eval_tiled times the backends the way it runs them, and then runs the
+# winner, tiling it if it isn't multithreaded itself
+def test_eval_tiled_auto():
+    fun = compile.demo_compile(
+        session.evaluation, session.parse("Sin[x] Cos[y] + a"), ["x", "y", "a"], lib="auto", grid_names=["x", "y"]
+    )
+    xs, ys = np.meshgrid(np.linspace(0, 1, 400), np.linspace(0, 1, 300))
+    result = plot.eval_tiled(fun, fun.invariants(x=xs, y=ys), {"x": xs, "y": ys}, {"a": 2.0})
+    assert np.allclose(result, np.sin(xs) * np.cos(ys) + 2)
+    assert list(fun.results()) == [(xs.size, True)]
+    assert fun.parallel == fun.last.parallel
+
+# a free variable, which the compiled code couldn't find, makes the 3-D plots fall back
+# to Mathics, or be left unevaluated if Mathics doesn't have them
+def test_plot3d_free_variable():
+    session.evaluate("k = 2")
+    for name in ["Plot3D", "DensityPlot"]:
+        result = session.evaluate(f"{name}[Sin[k x] y, {{x, 0, 3}}, {{y, 0, 1}}, PlotPoints -> 5]")
+        assert str(result.head) in ("System`Graphics3D", "System`Graphics")
+    for src in ["ContourPlot[Sin[k x] y, {x, 0, 3}, {y, 0, 1}]", "ComplexPlot3D[k z, {z, -1 - I, 1 + I}]"]:
+        assert str(session.evaluate(src).head) == "System`" + src.split("[")[0]
+
+# without MaxRecursion we sample at the same points as Mathics
+def test_plot_base_points(monkeypatch):
+    src = "Plot[Sin[x], {x, 0, 3}, PlotPoints -> 10, MaxRecursion -> 0]"
+    [line] = plot_lines(src)
+    [expected] = mathics_plot_lines(src, monkeypatch)
+    assert np.allclose(line, expected)
+
+# a kink is refined down to the finest spacing, on the curve, and straight parts aren't
+def test_plot_kink():
+    [line] = plot_lines("Plot[Abs[x - 0.3], {x, -1, 1}, PlotPoints -> 5, MaxRecursion -> 3]")
+    xs, ys = line.T
+    assert np.allclose(ys, abs(xs - 0.3))
+    i = np.searchsorted(xs, 0.3)
+    assert xs[i] - xs[i-1] == 0.5 / 2**3
+    assert not ((-1 < xs) & (xs < -0.5)).any()
+
+# refinement stops at max_plot_points
+def test_plot_max_points(monkeypatch):
+    monkeypatch.setattr(plot, "max_plot_points", 30)
+    [line] = plot_lines("Plot[Sin[1/x], {x, 0.01, 1}, PlotPoints -> 10, MaxRecursion -> 10]")
+    assert len(line) == 30
+
+# the triangles of a 3-D plot, as an array of shape (n, 3, 3), and all of its points
+def plot3d_triangles(src):
+    xyzs, ijks, _, _, _ = graphics.collect_graphics(session.evaluate(src))
+    return xyzs[ijks], xyzs
+
+# the area of each triangle projected onto the x, y plane
+def projected_areas(triangles):
+    a, b = triangles[:, 1, :2] - triangles[:, 0, :2], triangles[:, 2, :2] - triangles[:, 0, :2]
+    return abs(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]) / 2
+
+# adaptive Plot3D refines the peak down to the finest grid, leaves the flat corners
+# as the cells whose edges were tested at the first level, and covers the plot range
+# with no cracks or overlaps
+def test_plot3d_adaptive():
+    f = lambda x, y: np.exp(-50 * (x**2 + y**2))
+    triangles, xyzs = plot3d_triangles("Plot3D[Exp[-50 (x^2 + y^2)], {x, -2, 2}, {y, -2, 2}]")
+    assert np.allclose(xyzs[:, 2], f(xyzs[:, 0], xyzs[:, 1]))
+    assert np.isclose(projected_areas(triangles).sum(), 16)
+    level1, fine = 4 / ((plot.adaptive_points - 1) * 2), 4 / ((plot.adaptive_points - 1) * 4)
+    vertices = triangles.reshape(-1, 3)
+    near = np.unique(vertices[(abs(vertices[:, 0]) < 0.2) & (abs(vertices[:, 1]) < 0.2), 0])
+    assert np.allclose(np.diff(near), fine)
+    corner = vertices[(vertices[:, 0] > 1.5) & (vertices[:, 1] > 1.5), :2] + 2
+    assert np.allclose(np.round(corner / level1) * level1, corner)
+
+# no cell is split once there are max_plot3d_points points
+def test_plot3d_adaptive_max_points(monkeypatch):
+    monkeypatch.setattr(plot, "max_plot3d_points", 3000)
+    triangles, xyzs = plot3d_triangles("Plot3D[Exp[-50 (x^2 + y^2)], {x, -2, 2}, {y, -2, 2}]")
+    assert len(xyzs) == (2 * (plot.adaptive_points - 1) + 1) ** 2
+    assert np.isclose(projected_areas(triangles).sum(), 16)
+
+# cells where the function is finite at only some points are refined, so the
+# surface reaches to within about the finest grid of where it ends
+def test_plot3d_adaptive_edge():
+    triangles, _ = plot3d_triangles("Plot3D[Sqrt[1 - x^2 - y^2], {x, -1, 1}, {y, -1, 1}]")
+    triangles = triangles[np.isfinite(triangles[:, :, 2]).all(axis=1)]
+    assert np.allclose(triangles[:, :, 2], np.sqrt(1 - triangles[:, :, 0]**2 - triangles[:, :, 1]**2))
+    fine = 2 / ((plot.adaptive_points - 1) * 4)
+    assert 0 < np.pi - projected_areas(triangles).sum() < 2 * np.pi * fine
+
+# Plot3D of several functions gives a surface for each, whose polygons index its own
+# points once collect_graphics has put them all together
+def test_plot3d_surfaces():
+    src = "Plot3D[{x y, 1 - x y}, {x, 0, 1}, {y, 0, 1}, PlotPoints -> 5, MaxRecursion -> 0]"
+    result = session.evaluate(src)
+    assert len(result.elements[0].elements) == 2
+    triangles, xyzs = plot3d_triangles(src)
+    assert len(xyzs) == 2 * 25
+    first, second = triangles[:len(triangles) // 2], triangles[len(triangles) // 2:]
+    assert np.allclose(first[:, :, 2], first[:, :, 0] * first[:, :, 1])
+    assert np.allclose(second[:, :, 2], 1 - second[:, :, 0] * second[:, :, 1])
+
+# adaptive Plot3D of several functions refines them on one grid, where any of them needs it
+def test_plot3d_surfaces_adaptive():
+    triangles, xyzs = plot3d_triangles("Plot3D[{Exp[-50 (x^2 + y^2)], 0}, {x, -2, 2}, {y, -2, 2}]")
+    first, second = np.split(xyzs, 2)
+    assert np.array_equal(first[:, :2], second[:, :2]) and not second[:, 2].any()
+    first, second = np.split(triangles, 2)
+    assert np.array_equal(first[:, :, :2], second[:, :, :2])
+
+# ComplexPlot3D plots the absolute value over the complex plane
+def test_complex_plot3d():
+    _, xyzs = plot3d_triangles("ComplexPlot3D[z^2 + 1, {z, -1 - I, 1 + I}, PlotPoints -> 10, MaxRecursion -> 0]")
+    z = xyzs[:, 0] + 1j * xyzs[:, 1]
+    assert len(xyzs) == 100 and np.allclose(xyzs[:, 2], abs(z**2 + 1))
+
+# ParametricPlot3D gives the points of each surface on the (u, v) grid
+def test_parametric_plot3d():
+    triangles, xyzs = plot3d_triangles("ParametricPlot3D[{{u, v, u v}, {u, v, -u v}}, {u, -1, 1}, {v, -1, 1}, PlotPoints -> 10]")
+    assert len(xyzs) == 2 * 100
+    first, second = np.split(triangles, 2)
+    assert np.allclose(first[:, :, 2], first[:, :, 0] * first[:, :, 1])
+    assert np.allclose(second[:, :, 2], -second[:, :, 0] * second[:, :, 1])
+
+# DensityPlot gives the values on the grid as a Raster whose cells are centered on the grid points
+def test_density_plot():
+    _, _, lines, _, [(values, bounds)] = graphics.collect_graphics(
+        session.evaluate("DensityPlot[x + 10 y, {x, 0, 1}, {y, 0, 2}, PlotPoints -> {11, 21}]")
+    )
+    assert not lines
+    xs, ys = np.meshgrid(np.linspace(0, 1, 11), np.linspace(0, 2, 21))
+    assert np.allclose(values, xs + 10 * ys)
+    assert np.allclose(bounds, [[-0.05, -0.05], [1.05, 2.05]])
+
+# the contours of x^2 + y^2 are circles
+def test_contour_plot():
+    lines = plot_lines("ContourPlot[x^2 + y^2, {x, -1.5, 1.5}, {y, -1.5, 1.5}, Contours -> {1}]")
+    segments = np.array(lines)
+    assert segments.shape[1:] == (2, 2)
+    assert np.allclose(np.hypot(segments[..., 0], segments[..., 1]), 1, atol=1e-3)
+    lengths = np.hypot(*(segments[:, 1] - segments[:, 0]).T)
+    assert np.isclose(lengths.sum(), 2 * np.pi, rtol=1e-3)
+
+# a saddle cell is cut into two segments, separating the corners on the other side from the center
+def test_contour_saddle():
+    xs, ys = np.meshgrid([0.0, 1.0], [0.0, 1.0])
+    segments = plot.contour_segments(xs, ys, np.array([[1.0, -1.0], [-1.0, 1.0]]), 0)
+    assert np.allclose(sorted(map(sorted, segments.tolist())), [[[0, 0.5], [0.5, 0]], [[0.5, 1], [1, 0.5]]])